@@ -49,7 +49,6 @@ setup(
 
     packages = find_packages(),
     namespace_packages = ['terms'],
-    test_suite = 'nose.collector',
     include_package_data = True,
 
     entry_points = {
@@ -57,10 +56,13 @@ setup(
             'terms = terms.core.scripts.repl:repl',
             'initterms = terms.core.scripts.initterms:init_terms',
             'kbdaemon = terms.core.scripts.kbdaemon:main',
+            'termsstats = terms.core.scripts.termsstats:rebuild_stats',
+            'termsmigrate = terms.core.scripts.termsmigrate:migrate',
+            'termscompact = terms.core.scripts.termscompact:compact',
         ],
     },
     tests_require = [
-        'Nose',
+        'pytest',
         'coverage',
     ],
     extras_require = {
@@ -68,7 +70,7 @@ setup(
         },
     install_requires = [
         'distribute',
-        'sqlalchemy == 0.9.3',
+        'sqlalchemy >= 0.9.5, < 1.0',
         'ply == 3.4',
     ],
 )
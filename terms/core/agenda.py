@@ -0,0 +1,109 @@
+# Copyright (c) 2007-2012 by Enrique Pérez Arnaud <enriquepablo@gmail.com>
+#
+# This file is part of the terms project.
+# https://github.com/enriquepablo/terms
+#
+# The terms project is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The terms project is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any part of the terms project.
+# If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+from collections import deque, Counter
+
+from terms.core.exceptions import AgendaOverflow
+
+
+class Agenda(object):
+    '''
+    The queue of activations (matches for derived facts)
+    waiting to be dispatched through the network.
+
+    The strategy (config['agenda_strategy']) can be:
+     * fifo: breadth first, in the order the activations were produced;
+     * lifo: depth first, the last activation produced goes first;
+     * salience: activations of the rules with more premises
+       (more specific rules) go first, fifo among equals.
+
+    config['agenda_max_size'] limits the number of activations
+    that can be waiting in the agenda,
+    and config['agenda_max_activations'] limits the number of activations
+    that can be dispatched for a single fact told to the network
+    (for a batch of facts, that many times the number of facts).
+    In both cases 0 means no limit, and going over the limit
+    raises AgendaOverflow.
+
+    counts keeps the number of activations produced by each rule,
+    for the lifetime of the agenda; report() formats them.
+    '''
+
+    strategies = ('fifo', 'lifo', 'salience')
+
+    def __init__(self, config):
+        self.strategy = config['agenda_strategy']
+        if self.strategy not in self.strategies:
+            raise ValueError('Unknown agenda strategy: ' + self.strategy)
+        self.max_size = int(config['agenda_max_size'])
+        self.max_activations = int(config['agenda_max_activations'])
+        self.queue = deque()
+        self.heap = []
+        self.seq = 0
+        self.dispatched = 0
+        self.facts = 1
+        self.counts = Counter()  # rule id -> number of activations
+
+    def __len__(self):
+        if self.strategy == 'salience':
+            return len(self.heap)
+        return len(self.queue)
+
+    def push(self, match, rule):
+        if self.max_size and len(self) >= self.max_size:
+            raise AgendaOverflow('Too many activations waiting '
+                                 'in the agenda (%d)' % self.max_size)
+        self.counts[rule.id] += 1
+        if self.strategy == 'salience':
+            self.seq += 1
+            heapq.heappush(self.heap, (-len(rule.prems), self.seq, match))
+        else:
+            self.queue.append(match)
+
+    def pop(self):
+        limit = self.max_activations * self.facts
+        if limit and self.dispatched >= limit:
+            raise AgendaOverflow('Too many activations for %d fact(s) '
+                                 '(%d)' % (self.facts, limit))
+        self.dispatched += 1
+        if self.strategy == 'salience':
+            return heapq.heappop(self.heap)[2]
+        elif self.strategy == 'lifo':
+            return self.queue.pop()
+        return self.queue.popleft()
+
+    def reset(self):
+        '''
+        Empty the agenda and start counting activations
+        for a new fact.
+        '''
+        self.queue.clear()
+        self.heap = []
+        self.dispatched = 0
+        self.facts = 1
+
+    def report(self):
+        '''
+        The number of activations produced by each rule,
+        busiest rules first.
+        '''
+        return 'Activations by rule: ' + ', '.join(
+            'rule %d: %d' % (rule_id, n)
+            for rule_id, n in self.counts.most_common())
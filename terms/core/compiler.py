@@ -28,6 +28,7 @@ from sqlalchemy.orm.exc import NoResultFound
 
 from terms.core.patterns import SYMBOL_PAT, VAR_PAT, NUM_PAT
 from terms.core.network import Network, CondIsa, CondIs, CondCode
+from terms.core.lexicon import TermWriter
 from terms.core.terms import isa, Predicate, Import
 from terms.core.exceptions import TermsSyntaxError, WrongObjectType, WrongLabel, ImportProblems
 
@@ -556,6 +557,7 @@ class Compiler(object):
             if len(asts) == 1:
                 return self.compile(asts[0])
             asts.reverse()
+            asts = self._join_definitions(self._join_factsets(asts))
             for ast in asts:
                 self.compile(ast)
             if url is not None:  # XXX Save import even if compile throws an exceptin, saving the line it was thrown at?
@@ -565,9 +567,49 @@ class Compiler(object):
                 self.session.commit()
         return 'OK'
 
+    def _join_factsets(self, asts):
+        '''
+        Join runs of consecutive fact-sets into single fact-sets,
+        so that they are added in batches.
+        '''
+        joined = []
+        for ast in asts:
+            if (ast.type == 'fact-set' and joined and
+                    joined[-1].type == 'fact-set'):
+                facts = joined[-1].facts + ast.facts
+                joined[-1] = AstNode('fact-set', facts=facts)
+            else:
+                joined.append(ast)
+        return joined
+
+    def _join_definitions(self, asts):
+        '''
+        Join runs of at least bulk_definitions consecutive definitions
+        into definition-sets, so that their terms are added in bulk.
+        '''
+        size = int(self.config['bulk_definitions'])
+        if not size:
+            return asts
+        joined, run = [], []
+        for ast in asts + [None]:
+            if ast is not None and ast.type == 'definition':
+                run.append(ast)
+                continue
+            if len(run) >= size:
+                defs = [a.definition for a in run]
+                joined.append(AstNode('definition-set', definitions=defs))
+            else:
+                joined.extend(run)
+            run = []
+            if ast is not None:
+                joined.append(ast)
+        return joined
+
     def compile(self, ast):
         if ast.type == 'definition':
             return self.compile_definition(ast.definition)
+        elif ast.type == 'definition-set':
+            return self.compile_definitions(ast.definitions)
         elif ast.type == 'rule':
             return self.compile_rule(ast)
         elif ast.type == 'instant-rule':
@@ -591,11 +633,46 @@ class Compiler(object):
         self.session.commit()
         return term
 
+    def compile_definitions(self, definitions):
+        '''
+        Add the terms of many definitions with a TermWriter,
+        and commit once.
+        Definitions that cannot be added in bulk
+        are compiled one by one, after the terms before them are written.
+        '''
+        writer = TermWriter(self.lexicon, [d.name.val for d in definitions])
+        for defn in definitions:
+            if defn.type == 'verb-def':
+                bases = [writer.get_term(t.val) for t in defn.bases]
+                objs = {o.label: writer.get_term(o.obj_type.val)
+                        for o in defn.objs}
+                done = writer.add_subterm(defn.name.val, bases, objs)
+            elif defn.type == 'noun-def':
+                bases = [writer.get_term(t.val) for t in defn.bases]
+                done = writer.add_subterm(defn.name.val, bases, {})
+            elif defn.type == 'name-def':
+                term_type = writer.get_term(defn.term_type.val)
+                done = writer.add_term(defn.name.val, term_type)
+            if not done:
+                writer.write()
+                self.compile_definition(defn)
+        writer.write()
+        if self.network.wide is not None:
+            for defn in definitions:
+                if defn.type == 'verb-def':
+                    verb = self.lexicon.get_term(defn.name.val)
+                    self.network.wide.create_table(verb)
+        self.session.commit()
+        return 'OK'
+
     def compile_verbdef(self, defn):
         bases = [self.lexicon.get_term(t.val) for t in defn.bases]
         objs = {o.label: self.lexicon.get_term(o.obj_type.val)
                 for o in defn.objs}
-        return self.lexicon.add_subterm(defn.name.val, bases, **objs)
+        verb = self.lexicon.add_subterm(defn.name.val, bases, **objs)
+        if self.network.wide is not None:
+            self.network.wide.create_table(verb)
+        return verb
 
     def compile_noundef(self, defn):
         bases = [self.lexicon.get_term(t.val) for t in defn.bases]
@@ -635,9 +712,18 @@ class Compiler(object):
         # remove premnodes & nodes that have no other rules
         for prem in rule.prems:
             if len(prem.node.prems) == 1:
-                node = prem.node
-                while len(node.parent.children) == 1:
+                self.network.forget_premnode(prem.node)
+                node = prem.node.parent
+                if node.children.count():
+                    node.terminal = None
+                    if self.network.nodes is not None:
+                        self.network.nodes.add_node(node)
+                    continue
+                while (node.parent is not self.network.root and
+                       node.parent.children.count() == 1):
                     node = node.parent
+                if self.network.nodes is not None:
+                    self.network.nodes.remove_node(node)
                 self.session.delete(node)
         self.session.delete(rule)
         return 'OK'
@@ -704,31 +790,69 @@ class Compiler(object):
             return CondIs(name, base)
 
     def compile_factset(self, facts):
-        for f in facts:
-            pred = self.compile_fact(f)
-            self.network.add_fact(pred)
+        '''
+        Add the facts in batches of commit_many_facts
+        (all of them in one batch if it is 0),
+        committing after each batch.
+        '''
+        size = int(self.config['commit_many_facts']) or len(facts)
+        for n in range(0, len(facts), size):
+            preds = [self.compile_fact(f) for f in facts[n:n + size]]
+            self.network.add_facts(preds)
             self.session.commit()
         return 'OK'
 
-    def compile_question(self, sentences):
-        matches = []
-        if sentences:
-            facts, defs = [], []
-            for s in sentences:
-                if s.type == 'fact':
-                    facts.append(s)
-                else:
-                    defs.append(s)
-            q = [self.compile_fact(f) for f in facts]
-            matches = self.network.query(*q)
-            for defn in defs:
-                if defn.type == 'noun-def':
-                    if defn.name.type == 'var':
-                        terms = self.lexicon.get_terms
-                        #  XXX unfinished
-                elif defn.type == 'name-def':
-                    term = self.compile_namedef(defn)
+    def _parse_question(self, s):
+        s = '\n'.join([l for l in s.splitlines() if l and not l.startswith('#')])
+        module = self.parser.parse(s)
+        asts = module.code
+        if len(asts) != 1 or asts[0].type != 'question':
+            raise TermsSyntaxError('expected a single question')
+        return asts[0].facts
+
+    def parse_question(self, s, offset=None, limit=None):
+        '''
+        Parse a single question,
+        and return an iterator over its matches,
+        or over limit of them after the first offset,
+        in the order given by Network.iter_query.
+        '''
+        q = self._question_preds(self._parse_question(s))
+        return self.network.iter_query(*q, offset=offset, limit=limit)
+
+    def count_question(self, s):
+        '''
+        Parse a single question, and count its matches in the db.
+        '''
+        q = self._question_preds(self._parse_question(s))
+        if not q:
+            return 0
+        return self.network.query_count(*q)
+
+    def _question_preds(self, sentences):
+        facts, defs = [], []
+        for s in sentences:
+            if s.type == 'fact':
+                facts.append(s)
+            else:
+                defs.append(s)
+        q = [self.compile_fact(f) for f in facts]
+        for defn in defs:
+            if defn.type == 'noun-def':
+                if defn.name.type == 'var':
+                    terms = self.lexicon.get_terms
+                    #  XXX unfinished
+            elif defn.type == 'name-def':
+                term = self.compile_namedef(defn)
+        return q
 
+    def compile_question(self, sentences):
+        q = self._question_preds(sentences)
+        if not q:
+            return 'false'
+        if not any(has_vars(pred) for pred in q):
+            return self.network.query_exists(*q) and 'true' or 'false'
+        matches = list(self.network.iter_query(*q))
         if not matches:
             matches = 'false'
         elif not matches[0]:
@@ -767,15 +891,20 @@ class Compiler(object):
         return 'OK'
 
 
+def has_vars(pred):
+    '''
+    Whether a sentence in a question has variables;
+    the sentence can also be a bare var, as in "(Exist1)?".
+    '''
+    if isinstance(pred, Predicate):
+        return bool(pred.get_vars())
+    return bool(pred.var)
+
+
 class Runtime(object):
 
     def __init__(self, compiler):
         self.compiler = compiler
 
     def count(self, sen):
-        resp = self.compiler.parse(sen + '?')
-        if resp == 'false':
-            return 0
-        elif resp == 'true':
-            return 1
-        return len(resp)
+        return self.compiler.count_question(sen + '?')
@@ -18,40 +18,178 @@
 # If not, see <http://www.gnu.org/licenses/>.
 
 import operator
+import hashlib
+import weakref
 
-from sqlalchemy import Table, Column, Sequence
+from sqlalchemy import Table, Column, Sequence, Index, event
 from sqlalchemy import ForeignKey, Integer, String, Boolean
-from sqlalchemy.orm import relationship, backref, aliased
+from sqlalchemy.orm import relationship, backref, aliased, joinedload
 from sqlalchemy import sql
 
-from terms.core.terms import get_bases
-from terms.core.terms import Base, Term
+from terms.core.terms import Base, Term, Predicate, Object
 from terms.core.terms import isa
 from terms.core.utils import Match
 
 
+# max number of facts (or predicates) per statement in bulk operations
+CHUNK = 400
+
+# labels added to facts by the factsets, that are not in every signature
+TIME_LABELS = ('since_', 'till_', 'at_')
+
+
+def _canonical(pred):
+    p = not pred.true and '!' or ''
+    p = [p + pred.term_type.name]
+    for label in sorted(pred.objects):
+        if label == 'since_':
+            continue
+        value = pred.get_object(label)
+        if isinstance(value, Predicate):
+            value = _canonical(value)
+        else:
+            value = value.name
+        p.append('%s %s' % (label, value))
+    return '(%s)' % ', '.join(p)
+
+
+def fact_key(pred):
+    '''
+    A digest of the verb, truth value, labels and values of pred,
+    recursively, that identifies it as a fact.
+    The since_ label is left out,
+    since it is added to facts when they are stored.
+    '''
+    return hashlib.sha1(_canonical(pred).encode('utf8')).hexdigest()
+
+
+class PathIndex(object):
+    '''
+    In-process map from the dotted paths of segments
+    to their ids in the paths table.
+    Paths that are not in the table are inserted
+    the first time they are asked for.
+    Since new paths are inserted in the session's transaction,
+    the map is cleared when it is rolled back.
+    '''
+
+    def __init__(self, session):
+        self.session = session
+        self.ids = None
+        event.listen(session, 'after_rollback', self.clear)
+
+    def clear(self, *args):
+        self.ids = None
+
+    def _load(self):
+        table = SegmentPath.__table__
+        q = sql.select([table.c.path, table.c.id])
+        self.ids = dict(self.session.execute(q).fetchall())
+
+    def get(self, path, create=True):
+        '''
+        Get the id for path (a tuple of strings).
+        If it is not in the paths table and not create,
+        return None.
+        '''
+        if self.ids is None:
+            self._load()
+        path_str = '.'.join(path)
+        try:
+            return self.ids[path_str]
+        except KeyError:
+            pass
+        table = SegmentPath.__table__
+        q = sql.select([table.c.id]).where(table.c.path==path_str)
+        pid = self.session.execute(q).scalar()
+        if pid is None:
+            if not create:
+                return None
+            result = self.session.execute(table.insert().values(path=path_str))
+            pid = result.inserted_primary_key[0]
+        self.ids[path_str] = pid
+        return pid
+
+
+_path_indexes = weakref.WeakKeyDictionary()
+
+
+def get_path_index(session):
+    '''
+    Get the PathIndex for session,
+    shared by all factsets that use it.
+    '''
+    try:
+        return _path_indexes[session]
+    except KeyError:
+        index = _path_indexes[session] = PathIndex(session)
+        return index
+
+
+
+class ColumnVar(object):
+    '''
+    Stands in taken_vars for the alias of the segment
+    that binds a var, when the var is bound by a column
+    of some other table.
+    '''
+
+    def __init__(self, column):
+        self.term_id = column
+        self.int_value = column
+        self.verb_id = column
 
 
 class FactSet(object):
     """
     """
 
-    def __init__(self, name, lexicon, config):
+    sql = True  # queries can be extended with further joins
+
+    def __init__(self, name, lexicon, config, unique=False,
+                 touch=None, wide=None, intervals=False):
         self.name = name
         self.config = config
         self.session = lexicon.session
         self.lexicon = lexicon
+        self.unique = unique  # facts are stored with a unique key
+        self.touch = touch  # called with the verb of each new fact
+        self.wide = wide  # WideFacts, to also store facts in wide tables
+        self.intervals = intervals  # keep the time labels in factintervals
+        self.bulk = bool(int(config['bulk_writes']))  # write with FactWriter
+        if intervals:
+            self.partition_size = int(config['past_partition_size'])
+        self.paths = get_path_index(self.session)
+        # facts (and their preds) written in bulk and then loaded
+        # in the current transaction; the session does not know they are new,
+        # so they must be expunged on rollback, before their ids are reused.
+        self.loaded = []
+        event.listen(self.session, 'after_commit', self._forget_loaded)
+        event.listen(self.session, 'after_rollback', self._expunge_loaded)
+
+    def _forget_loaded(self, *args):
+        self.loaded = []
+
+    def _expunge_loaded(self, session):
+        for obj in self.loaded:
+            if obj in session:
+                session.expunge(obj)
+        self.loaded = []
 
     def get_paths(self, pred):
         '''
         build a path for each testable feature in term.
         Each path is a tuple of strings,
         and corresponds to a node in the primary network.
+        Segments refer to paths by the ids given by path_id.
         '''
         paths = []
         self._recurse_paths(pred, paths, ())
         return paths
 
+    def path_id(self, path, create=True):
+        return self.paths.get(path, create=create)
+
     def _recurse_paths(self, pred, paths, path):
         paths.append(path + ('_verb',))
         if not isa(pred, self.lexicon.verb):  # not a verb var
@@ -71,58 +209,361 @@ class FactSet(object):
         return mapper.base_mapper.polymorphic_map[ntype].class_
 
     def add_fact(self, pred):
+        if self.bulk:
+            return self.add_facts([pred])[0]
         print(pred)
         fact = Fact(pred, self.name)
+        if self.unique:
+            fact.key = fact_key(pred)
         paths = self.get_paths(pred)
         for path in paths:
             cls = self._get_nclass(path)
             value = cls.resolve(pred, path, self)
-            cls(fact, value, path)
+            cls(fact, value, self.path_id(path))
         self.session.add(fact)
         self.session.flush()
+        if self.wide is not None:
+            self.wide.add_fact(fact, pred)
+        if self.intervals:
+            self.add_intervals([fact.id], [pred])
+        if self.touch is not None:
+            self.touch(pred.term_type)
         return fact
 
+    def add_facts(self, preds):
+        '''
+        Add many facts at once, inserting their rows
+        with one executemany per table.
+        Return the new facts, in the same order as preds.
+        '''
+        writer = FactWriter(self)
+        for pred in preds:
+            print(pred)
+            writer.add(pred)
+        ids = writer.write()
+        if self.touch is not None:
+            for verb in {pred.term_type for pred in preds}:
+                self.touch(verb)
+        return self._load_facts(ids)
+
+    def _load_facts(self, ids):
+        facts = {}
+        for n in range(0, len(ids), CHUNK):
+            chunk = ids[n:n + CHUNK]
+            qfacts = self.session.query(Fact).options(joinedload(Fact.pred))
+            for fact in qfacts.filter(Fact.id.in_(chunk)):
+                facts[fact.id] = fact
+                self.loaded.extend((fact, fact.pred))
+        return [facts[i] for i in ids]
+
+    def filter_new(self, preds):
+        '''
+        Given a sequence of predicates,
+        return those that are not already in the factset,
+        removing repetitions.
+        The check is done with a single query
+        for every CHUNK predicates.
+        '''
+        unique, seen = [], set()
+        for pred in preds:
+            key = self.unique and fact_key(pred) or str(pred)
+            if key not in seen:
+                seen.add(key)
+                unique.append((key, pred))
+        if self.unique:
+            found = set()
+            keys = [key for key, pred in unique]
+            for n in range(0, len(keys), CHUNK):
+                q = sql.select([Fact.__table__.c.key])
+                q = q.where(Fact.__table__.c.key.in_(keys[n:n + CHUNK]))
+                found.update(row[0] for row in self.session.execute(q))
+            return [p for key, p in unique if key not in found]
+        unique = [pred for key, pred in unique]
+        found = set()
+        for n in range(0, len(unique), CHUNK):
+            exists = []
+            for m, pred in enumerate(unique[n:n + CHUNK]):
+                qfacts = self.query_facts(pred, {})
+                exists.append(sql.select([sql.literal(n + m)]).where(qfacts.exists()))
+            if len(exists) > 1:
+                q = sql.union_all(*exists)
+            else:
+                q = exists[0]
+            found.update(row[0] for row in self.session.execute(q))
+        return [p for n, p in enumerate(unique) if n not in found]
+
+    def get_fact(self, pred):
+        '''
+        Get the fact for pred, or None if it is not in the factset.
+        '''
+        if self.unique:
+            key = fact_key(pred)
+            return self.session.query(Fact).filter(Fact.key==key).first()
+        return self.query_facts(pred, {}).first()
+
+    def forget_fact(self, fact):
+        '''
+        Called when a fact is about to be deleted.
+        '''
+        self.forget_facts([fact.id])
+
+    def forget_facts(self, fact_ids):
+        '''
+        Called when many facts are about to be deleted.
+        '''
+        if self.intervals:
+            itable = FactInterval.__table__
+            for n in range(0, len(fact_ids), CHUNK):
+                chunk = fact_ids[n:n + CHUNK]
+                self.session.execute(itable.delete().where(itable.c.fact_id.in_(chunk)))
+
+    def add_intervals(self, fact_ids, preds):
+        '''
+        Insert the factintervals rows for new facts.
+        '''
+        rows = []
+        for fact_id, pred in zip(fact_ids, preds):
+            row = {'fact_id': fact_id, 'part': None}
+            for label in TIME_LABELS:
+                row[label] = None
+                if label in pred.objects:
+                    row[label] = int(pred.get_object(label).name)
+            if row['at_'] is not None:
+                row['part'] = row['at_'] // self.partition_size
+            rows.append(row)
+        self.session.execute(FactInterval.__table__.insert(), rows)
+
+    def move_intervals(self, fact_ids, label, value):
+        '''
+        Insert the factintervals rows for facts moved into this factset,
+        taking the time labels from their segments,
+        except label, that is given as value.
+        '''
+        itable = FactInterval.__table__
+        path_ids = dict((l, self.path_id((l, '_num'), create=False))
+                        for l in TIME_LABELS)
+        names = ['fact_id', 'part'] + list(TIME_LABELS)
+        for n in range(0, len(fact_ids), CHUNK):
+            where = Fact.__table__.c.id.in_(fact_ids[n:n + CHUNK])
+            q = select_intervals(path_ids, where, self.partition_size,
+                                 {label: value})
+            self.session.execute(itable.insert().from_select(names, q))
+
+    def fact_ids(self, pred, verbs=None):
+        '''
+        The ids of the facts that match pred, and of their predicates.
+        If verbs (a set of ids) is given,
+        only facts with those verbs are taken.
+        '''
+        qfacts = self.query_facts(pred, {})
+        if verbs is not None:
+            ptable = Predicate.__table__
+            qfacts = qfacts.join(ptable, ptable.c.id==Fact.pred_id)
+            qfacts = qfacts.filter(ptable.c.type_id.in_(verbs))
+        return [tuple(row) for row in qfacts.with_entities(Fact.id, Fact.pred_id)]
+
+    def fact_ids_before(self, instant, verbs=None, exclude=None, limit=None):
+        '''
+        The ids of the facts whose at_ is before instant,
+        and of their predicates.
+        If verbs (a set of ids) is given, only facts with those verbs
+        are taken; if exclude is given, facts with those verbs are left out.
+        '''
+        ftable = Fact.__table__
+        q = sql.select([ftable.c.id, ftable.c.pred_id])
+        q = q.where(ftable.c.factset==self.name)
+        if self.intervals:
+            # the partitions before that of instant are taken whole,
+            # only in the partition of instant is at_ compared
+            ttable = FactInterval.__table__
+            part = instant // self.partition_size
+            q = q.where(sql.or_(ttable.c.part < part,
+                                sql.and_(ttable.c.part == part,
+                                         ttable.c.at_ < instant)))
+        else:
+            ttable = Segment.__table__.alias()
+            q = q.where(ttable.c.int_value < instant)
+            q = q.where(ttable.c.path_id==self.path_id(('at_', '_num'), create=False))
+        from_obj = ftable.join(ttable, ttable.c.fact_id==ftable.c.id)
+        if verbs is not None or exclude:
+            ptable = Predicate.__table__
+            from_obj = from_obj.join(ptable, ptable.c.id==ftable.c.pred_id)
+            if verbs is not None:
+                q = q.where(ptable.c.type_id.in_(verbs))
+            if exclude:
+                q = q.where(~ptable.c.type_id.in_(exclude))
+        q = q.select_from(from_obj).order_by(ftable.c.id)
+        if limit is not None:
+            q = q.limit(limit)
+        return [tuple(row) for row in self.session.execute(q)]
+
+    def get_verbs(self, pred_ids):
+        '''
+        The verbs of the given predicates.
+        '''
+        ptable = Predicate.__table__
+        verbs = set()
+        for n in range(0, len(pred_ids), CHUNK):
+            chunk = pred_ids[n:n + CHUNK]
+            q = self.session.query(Term).join(ptable, ptable.c.type_id==Term.id)
+            verbs.update(q.filter(ptable.c.id.in_(chunk)))
+        return verbs
+
+    def move_facts(self, rows, dest, label, term):
+        '''
+        Move facts, given as (fact id, pred id) rows, to the factset dest,
+        adding to their predicates an object with label and term
+        (a number).
+        All the facts are moved with a few statements,
+        and their rows are updated in place.
+        '''
+        if not rows:
+            return
+        fact_ids = [row[0] for row in rows]
+        pred_ids = [row[1] for row in rows]
+        path = (label, '_num')
+        self._move_segments(rows, dest, path, int(term.name))
+        if dest.intervals:
+            dest.move_intervals(fact_ids, label, int(term.name))
+        orows = [{'parent_id': pred_id, 'label': label, 'otype': 0,
+                  'term_id': term.id, 'pred_id': None}
+                 for pred_id in pred_ids]
+        self.session.execute(Object.__table__.insert(), orows)
+        ftable = Fact.__table__
+        for n in range(0, len(fact_ids), CHUNK):
+            chunk = fact_ids[n:n + CHUNK]
+            q = ftable.update().where(ftable.c.id.in_(chunk))
+            self.session.execute(q.values(factset=dest.name, key=None))
+        if self.wide is None and self.touch is None:
+            return
+        for verb in self.get_verbs(pred_ids):
+            if self.wide is not None:
+                self.wide.set_value(verb, fact_ids, label, int(term.name))
+            if self.touch is not None:
+                self.touch(verb)
+
+    def _move_segments(self, rows, dest, path, value):
+        path_id = dest.path_id(path)
+        srows = [{'fact_id': row[0], 'path_id': path_id, 'ntype': path[-1],
+                  'value': None, 'term_id': None, 'int_value': value,
+                  'verb_id': None}
+                 for row in rows]
+        self.session.execute(Segment.__table__.insert(), srows)
+
     def add_object_to_fact(self, fact, value, path):
         cls = self._get_nclass(path)
-        segment = cls(fact, value, path)
+        segment = cls(fact, value, self.path_id(path))
         self.session.add(segment)
+        if self.wide is not None and len(path) == 2:
+            self.wide.add_object(fact, path[0], value)
         fact.pred.add_object(path[-2], value)
 
-    def query_facts(self, pred, taken_vars, with_factset=True):
+    def query_facts(self, pred, taken_vars, with_factset=True,
+                    qfacts=None, fact=None):
+        '''
+        Build a query for the facts that match pred.
+        To add pred to a query that already joins other facts,
+        pass that query as qfacts, and the alias of Fact
+        to use for pred as fact;
+        vars in taken_vars (from the other facts) are joined on equality.
+        '''
         vars = []
         sec_vars = []
         paths = self.get_paths(pred)
-        qfacts = self.session.query(Fact)
+        if fact is None:
+            fact = Fact
+        if qfacts is None:
+            qfacts = self.session.query(Fact)
         if with_factset:
-            qfacts = qfacts.filter(Fact.factset==self.name)
+            qfacts = qfacts.filter(fact.factset==self.name)
+        if self.wide is not None and isinstance(pred, Predicate):
+            wtable = self.wide.get_table(pred.term_type)
+            if wtable is not None:
+                return self.wide.query_facts(self, wtable, pred, taken_vars,
+                                             qfacts, fact)
+        times, conditions = (), []
+        if self.intervals and isinstance(pred, Predicate):
+            times = [l for l in TIME_LABELS if l in pred.objects]
+            if times:
+                qfacts = self._filter_intervals(pred, times, taken_vars,
+                                                conditions, qfacts, fact)
         for path in paths:
+            if len(path) == 2 and path[0] in times:
+                continue
             cls = self._get_nclass(path)
             value = cls.resolve(pred, path, self)
             if value is not None:
-                qfacts = cls.filter_segment(qfacts, value, vars, path)
+                qfacts = cls.filter_segment(qfacts, value, vars, path, self, fact=fact)
         vars.sort(key=lambda x: 1 if getattr(x, 'set_condition', False) else 0)
         for var in vars:
-            qfacts = var['cls'].filter_segment_first_var(qfacts, var['value'], var['path'], self, taken_vars, sec_vars)
+            qfacts = var['cls'].filter_segment_first_var(qfacts, var['value'], var['path'], self, taken_vars, sec_vars, fact=fact)
         for var in sec_vars:
-            qfacts = var['cls'].filter_segment_sec_var(qfacts, var['path'], var['first'])
+            qfacts = var['cls'].filter_segment_sec_var(qfacts, var['path'], var['first'], self, fact=fact)
+        for condition in conditions:
+            condition = NumberSegment.compile_condition(condition, taken_vars)
+            qfacts = qfacts.filter(condition)
+        return qfacts
+
+    def _filter_intervals(self, pred, labels, taken_vars, conditions,
+                          qfacts, fact):
+        '''
+        Filter qfacts by the time labels of pred
+        with a single join of factintervals,
+        so that the interval indexes are used
+        instead of joining a segment for each label.
+        A given at_ also narrows the facts to its partition.
+        The conditions of new vars are appended to conditions,
+        to be compiled once all the vars of pred are bound.
+        '''
+        interval = aliased(FactInterval)
+        qfacts = qfacts.join(interval, interval.fact_id==fact.id)
+        for label in labels:
+            value = pred.get_object(label)
+            col = getattr(interval, label)
+            if not value.var:
+                qfacts = qfacts.filter(col==int(value.name))
+                if label == 'at_':
+                    part = int(value.name) // self.partition_size
+                    qfacts = qfacts.filter(interval.part==part)
+            elif value.name in taken_vars:
+                first = taken_vars[value.name][1]
+                qfacts = qfacts.filter(col==first.int_value)
+                if label == 'at_':
+                    part = first.int_value / self.partition_size
+                    qfacts = qfacts.filter(interval.part==part)
+            else:
+                taken_vars[value.name] = ((label, '_num'), ColumnVar(col))
+                qfacts = qfacts.filter(col!=None)
+                if getattr(value, 'set_condition', False):
+                    conditions.append(value.set_condition)
         return qfacts
 
     def query(self, pred):
+        return list(self.iter_query(pred))
+
+    def iter_query(self, pred):
+        '''
+        Iterate over the matches for pred,
+        loading the facts CHUNK at a time.
+        '''
         taken_vars = {}
         qfacts = self.query_facts(pred, taken_vars)
-        matches = []
-        for fact in qfacts:
+        for fact in qfacts.yield_per(CHUNK):
             match = Match(fact.pred, query=pred)
             match.fact = fact
             for name, path in taken_vars.items():
-                cls = self._get_nclass(path[0])
-                preds = True
-                if 'Verb' in name[1:]:
-                    preds = False
-                value = cls.resolve(fact.pred, path[0], self, preds=preds)
-                match[name] = value
-            matches.append(match)
-        return matches
+                match[name] = self.resolve_var(fact, name, path[0])
+            yield match
+
+    def resolve_var(self, fact, name, path):
+        '''
+        Get the value for the var name, at path in fact.
+        '''
+        cls = self._get_nclass(path)
+        preds = True
+        if 'Verb' in name[1:]:
+            preds = False
+        return cls.resolve(fact.pred, path, self, preds=preds)
 
 
 class Fact(Base):
@@ -134,12 +575,70 @@ class Fact(Base):
                          cascade='all',
                          primaryjoin="Predicate.id==Fact.pred_id")
     factset = Column(String(16))
+    key = Column(String(40), unique=True, index=True)
 
     def __init__(self, pred, name):
         self.pred = pred
         self.factset = name
 
 
+class FactInterval(Base):
+    '''
+    The time labels of a fact in the past,
+    to answer temporal questions with the indexes on at_
+    and on the interval (since_, at_) of facts that have finished.
+    Rows are partitioned by instant range:
+    part is at_ divided by past_partition_size,
+    so that questions for a given at_ only look in its partition,
+    and the retention of the past takes old partitions whole.
+    '''
+    __tablename__ = 'factintervals'
+
+    fact_id = Column(Integer, ForeignKey('facts.id'), primary_key=True)
+    part = Column(Integer, index=True)
+    since_ = Column(Integer)
+    till_ = Column(Integer)
+    at_ = Column(Integer, index=True)
+
+Index('ix_factintervals_since_at', FactInterval.since_, FactInterval.at_)
+
+
+def select_intervals(path_ids, where, size, values=None):
+    '''
+    Select factintervals rows for the facts in the where clause,
+    taking the time labels from their segments,
+    given the ids of the paths of the labels in path_ids,
+    or from values, a dict of labels to numbers.
+    '''
+    ftable = Fact.__table__
+    stable = Segment.__table__
+    values = values or {}
+    from_obj = ftable
+    cols = {}
+    for label in TIME_LABELS:
+        if label in values:
+            cols[label] = sql.literal(values[label])
+            continue
+        alias = stable.alias()
+        onclause = sql.and_(alias.c.fact_id==ftable.c.id,
+                            alias.c.path_id==path_ids[label])
+        from_obj = from_obj.outerjoin(alias, onclause)
+        cols[label] = alias.c.int_value
+    if 'at_' in values:
+        part = sql.literal(values['at_'] // size)
+    else:
+        part = cols['at_'] / size
+    columns = [ftable.c.id, part] + [cols[l] for l in TIME_LABELS]
+    return sql.select(columns, from_obj=[from_obj]).where(where)
+
+
+class SegmentPath(Base):
+    __tablename__ = 'paths'
+
+    id = Column(Integer, Sequence('path_id_seq'), primary_key=True)
+    path = Column(String, unique=True)
+
+
 class Segment(Base):
     __tablename__ = 'segments'
 
@@ -148,24 +647,24 @@ class Segment(Base):
     fact = relationship('Fact',
                          backref='segments',
                          primaryjoin="Fact.id==Segment.fact_id")
-    path = Column(String, index=True)
+    path_id = Column(Integer, ForeignKey('paths.id'))
 
     ntype = Column(String(5))
     __mapper_args__ = {'polymorphic_on': ntype}
 
-    def __init__(self, fact, value, path):
+    def __init__(self, fact, value, path_id):
         self.fact = fact
         self.value = value
-        self.path = '.'.join(path)
+        self.path_id = path_id
 
     @classmethod
-    def filter_segment(cls, qfact, value, vars, path):
+    def filter_segment(cls, qfact, value, vars, path, factset, fact=Fact):
         if getattr(value, 'var', False):
             vars.append({'cls': cls, 'value': value, 'path': path})
         else:
             alias = aliased(cls)
-            path_str = '.'.join(path)
-            qfact = qfact.join(alias, Fact.id==alias.fact_id).filter(alias.value==value, alias.path==path_str)
+            path_id = factset.path_id(path, create=False)
+            qfact = qfact.join(alias, fact.id==alias.fact_id).filter(alias.path_id==path_id, alias.value==value)
         return qfact
 
     @classmethod
@@ -181,10 +680,10 @@ class Segment(Base):
         return term
 
     @classmethod
-    def filter_segment_sec_var(cls, qfacts, path, salias):
+    def filter_segment_sec_var(cls, qfacts, path, salias, factset, fact=Fact):
         alias = aliased(cls)
-        path_str = '.'.join(path)
-        qfacts = qfacts.join(alias, Fact.id==alias.fact_id).filter(alias.path==path_str, alias.term_id==salias.term_id)
+        path_id = factset.path_id(path, create=False)
+        qfacts = qfacts.join(alias, fact.id==alias.fact_id).filter(alias.path_id==path_id, alias.term_id==salias.term_id)
         return qfacts
 
 
@@ -211,7 +710,7 @@ class TermSegment(Segment):
                          primaryjoin="Term.id==TermSegment.term_id")
 
     @classmethod
-    def filter_segment_first_var(cls, qfacts, value, path, factset, taken_vars, sec_vars):
+    def filter_segment_first_var(cls, qfacts, value, path, factset, taken_vars, sec_vars, fact=Fact):
         salias = aliased(cls)
         talias = aliased(Term)
         if value.name in taken_vars:
@@ -219,13 +718,13 @@ class TermSegment(Segment):
             return qfacts
         else:
             taken_vars[value.name] = (path, salias)
-        path_str = '.'.join(path)
+        path_id = factset.path_id(path, create=False)
+        qfacts = qfacts.join(salias, fact.id==salias.fact_id).filter(salias.path_id==path_id)
         if value.bases:
-            sbases = [b.id for b in factset.lexicon.get_subterms(value.bases[0])]
-            qfacts = qfacts.join(salias, Fact.id==salias.fact_id).filter(salias.path==path_str).join(talias, salias.term_id==talias.id).filter(talias.id.in_(sbases))
+            qfacts = factset.lexicon.join_subterms(qfacts, salias.term_id, value.bases[0])
         else:
-            sbases = [b.id for b in factset.lexicon.get_subterms(value.term_type)]
-            qfacts = qfacts.join(salias, Fact.id==salias.fact_id).filter(salias.path==path_str).join(talias, salias.term_id==talias.id).filter(talias.type_id.in_(sbases))
+            qfacts = qfacts.join(talias, salias.term_id==talias.id)
+            qfacts = factset.lexicon.join_subterms(qfacts, talias.type_id, value.term_type)
         return qfacts
 
 
@@ -254,12 +753,12 @@ class NumberSegment(Segment):
         '-': operator.neg,
     }
 
-    def __init__(self, fact, value, path):
+    def __init__(self, fact, value, path_id):
         self.fact = fact
         if getattr(value, 'name', False):
             value = int(value.name)
         self.value = value
-        self.path = '.'.join(path)
+        self.path_id = path_id
 
     @property
     def value(self):
@@ -270,26 +769,36 @@ class NumberSegment(Segment):
         self.int_value = val
 
     @classmethod
-    def filter_segment(cls, qfact, value, vars, path):
+    def filter_segment(cls, qfact, value, vars, path, factset, fact=Fact):
         if getattr(value, 'var', False):
             vars.append({'cls': cls, 'value': value, 'path': path})
         else:
             alias = aliased(cls)
-            path_str = '.'.join(path)
-            qfact = qfact.join(alias, Fact.id==alias.fact_id).filter(alias.int_value==int(value.name), alias.path==path_str)
+            path_id = factset.path_id(path, create=False)
+            qfact = qfact.join(alias, fact.id==alias.fact_id).filter(alias.path_id==path_id, alias.int_value==int(value.name))
         return qfact
 
     @classmethod
-    def filter_segment_first_var(cls, qfacts, value, path, factset, taken_vars, sec_vars):
+    def filter_segment_first_var(cls, qfacts, value, path, factset, taken_vars, sec_vars, fact=Fact):
         alias = aliased(cls)
+        if value.name in taken_vars:
+            sec_vars.append({'cls': cls, 'path': path, 'first': taken_vars[value.name][1]})
+            return qfacts
         taken_vars[value.name] = (path, alias)
-        path_str = '.'.join(path)
-        qfacts = qfacts.join(alias, Fact.id==alias.fact_id).filter(alias.path==path_str)
+        path_id = factset.path_id(path, create=False)
+        qfacts = qfacts.join(alias, fact.id==alias.fact_id).filter(alias.path_id==path_id)
         if getattr(value, 'set_condition', False):
             condition = cls.compile_condition(value.set_condition, taken_vars)
             qfacts = qfacts.filter(condition)
         return qfacts
 
+    @classmethod
+    def filter_segment_sec_var(cls, qfacts, path, salias, factset, fact=Fact):
+        alias = aliased(cls)
+        path_id = factset.path_id(path, create=False)
+        qfacts = qfacts.join(alias, fact.id==alias.fact_id).filter(alias.path_id==path_id, alias.int_value==salias.int_value)
+        return qfacts
+
     @classmethod
     def compile_condition(cls, expr, taken_vars):
         if expr.type == 's-vnum':
@@ -325,7 +834,7 @@ class VerbSegment(Segment):
         return term.term_type
 
     @classmethod
-    def filter_segment_first_var(cls, qfacts, value, path, factset, taken_vars, sec_vars):
+    def filter_segment_first_var(cls, qfacts, value, path, factset, taken_vars, sec_vars, fact=Fact):
         salias = aliased(cls)
         talias = aliased(Term)
         if value.name in taken_vars:
@@ -336,17 +845,189 @@ class VerbSegment(Segment):
 #        if value.name == 'Exists1':
 #            import pdb;pdb.set_trace()
         if isa(value, factset.lexicon.verb):
-            sbases = factset.lexicon.get_subterms(get_bases(value)[0])
+            root = value.bases[0]
         elif isa(value, factset.lexicon.exist):
-            sbases = factset.lexicon.get_subterms(value.term_type)
-        sbases = [b.id for b in sbases]
-        path_str = '.'.join(path)
-        qfacts = qfacts.join(salias, Fact.id==salias.fact_id).filter(salias.path==path_str).join(talias, salias.verb_id==talias.id).filter(talias.id.in_(sbases))
-        return qfacts
+            root = value.term_type
+        path_id = factset.path_id(path, create=False)
+        qfacts = qfacts.join(salias, fact.id==salias.fact_id).filter(salias.path_id==path_id)
+        return factset.lexicon.join_subterms(qfacts, salias.verb_id, root)
 
     @classmethod
-    def filter_segment_sec_var(cls, qfacts, path, salias):
+    def filter_segment_sec_var(cls, qfacts, path, salias, factset, fact=Fact):
         alias = aliased(cls)
-        path_str = '.'.join(path)
-        qfacts = qfacts.join(alias, Fact.id==alias.fact_id).filter(alias.path==path_str, alias.verb_id==salias.verb_id)
+        path_id = factset.path_id(path, create=False)
+        qfacts = qfacts.join(alias, fact.id==alias.fact_id).filter(alias.path_id==path_id, alias.verb_id==salias.verb_id)
         return qfacts
+
+
+# the segments of a path with a given value, leading to the fact
+Index('ix_segments_path_term_fact', Segment.path_id,
+      TermSegment.term_id, Segment.fact_id)
+Index('ix_segments_path_verb_fact', Segment.path_id,
+      VerbSegment.verb_id, Segment.fact_id)
+Index('ix_segments_path_num_fact', Segment.path_id,
+      NumberSegment.int_value, Segment.fact_id)
+
+
+class IdCounter(Base):
+    '''
+    The next id to allocate for a table,
+    on backends without sequences (sqlite).
+    '''
+    __tablename__ = 'id_counters'
+
+    name = Column(String(32), primary_key=True)
+    next = Column(Integer, default=1)
+
+
+def allocate_ids(session, counts):
+    '''
+    Reserve consecutive primary keys for several tables,
+    given as (table, n) pairs, and return a list of ids for each.
+    With sequences (postgresql) they are taken from the sequence
+    of the id column of each table,
+    otherwise (sqlite) they are reserved from the id_counters row
+    of each table, with an update that locks it
+    until the end of the transaction.
+    Counters never go back, so the ids of deleted rows are not reused,
+    and they skip the ids taken by rows inserted through the ORM.
+    '''
+    if session.bind.dialect.supports_sequences:
+        ids = []
+        for table, n in counts:
+            if n == 0:
+                ids.append([])
+                continue
+            seq = table.c.id.default
+            q = sql.select([seq.next_value()]).select_from(sql.func.generate_series(1, n))
+            ids.append([row[0] for row in session.execute(q)])
+        return ids
+    ctable = IdCounter.__table__
+    names = [table.name for table, n in counts]
+    for table, n in counts:
+        top = sql.select([sql.func.coalesce(sql.func.max(table.c.id), 0) + 1])
+        top = top.as_scalar()
+        start = sql.case([(ctable.c.next > top, ctable.c.next)], else_=top)
+        q = ctable.update().where(ctable.c.name==table.name)
+        if not session.execute(q.values(next=start + n)).rowcount:
+            session.execute(ctable.insert().values(name=table.name,
+                                                   next=top + n))
+    q = sql.select([ctable.c.name, ctable.c.next]).where(ctable.c.name.in_(names))
+    nexts = dict(session.execute(q).fetchall())
+    return [list(range(nexts[table.name] - n, nexts[table.name]))
+            for table, n in counts]
+
+
+class FactWriter(object):
+    '''
+    Collect the rows for many facts
+    (Fact, Predicate, Object and Segment rows)
+    and insert them with Core executemany's,
+    with primary keys preallocated.
+    '''
+
+    def __init__(self, factset, segments=True):
+        self.factset = factset
+        self.session = factset.session
+        self.with_segments = segments
+        self.facts = []
+        self.preds = []
+        self.objects = []
+        self.segments = []
+        self.new_terms = {}
+
+    def add(self, pred):
+        self._add_pred(pred)
+        n = len(self.facts)
+        self.facts.append(pred)
+        if not self.with_segments:
+            return
+        for path in self.factset.get_paths(pred):
+            cls = self.factset._get_nclass(path)
+            value = cls.resolve(pred, path, self.factset)
+            if isinstance(value, Term):
+                self._add_term(value)
+            self.segments.append((n, path, value))
+
+    def _add_pred(self, pred):
+        self.preds.append(pred)
+        self._add_term(pred.term_type)
+        for label in sorted(pred.objects):
+            value = pred.get_object(label)
+            if isinstance(value, Predicate):
+                self._add_pred(value)
+            else:
+                self._add_term(value)
+            self.objects.append((pred, label, value))
+
+    def _add_term(self, term):
+        if term.id is None:
+            if term.name in self.new_terms:
+                return
+            self.new_terms[term.name] = term
+            self.session.add(term)
+
+    def _term_id(self, term):
+        if term.id is None:
+            return self.new_terms[term.name].id
+        return term.id
+
+    def write(self):
+        '''
+        Insert all collected rows,
+        and return the ids of the new facts.
+        '''
+        if not self.facts:
+            return []
+        self.session.flush()
+        ptable = Predicate.__table__
+        otable = Object.__table__
+        ftable = Fact.__table__
+        stable = Segment.__table__
+        pids, oids, fids, sids = allocate_ids(self.session, (
+            (ptable, len(self.preds)), (otable, len(self.objects)),
+            (ftable, len(self.facts)), (stable, len(self.segments))))
+        pids = {id(p): i for p, i in zip(self.preds, pids)}
+        prows = [{'id': pids[id(p)], 'true': p.true,
+                  'type_id': self._term_id(p.term_type), 'rule_id': None}
+                 for p in self.preds]
+        orows = []
+        for oid, (pred, label, value) in zip(oids, self.objects):
+            row = {'id': oid, 'parent_id': pids[id(pred)], 'label': label,
+                   'otype': 0, 'term_id': None, 'pred_id': None}
+            if isinstance(value, Predicate):
+                row['otype'] = 1
+                row['pred_id'] = pids[id(value)]
+            else:
+                row['term_id'] = self._term_id(value)
+            orows.append(row)
+        unique = self.factset.unique
+        frows = [{'id': fid, 'pred_id': pids[id(p)],
+                  'factset': self.factset.name,
+                  'key': unique and fact_key(p) or None}
+                 for fid, p in zip(fids, self.facts)]
+        srows = []
+        for sid, (n, path, value) in zip(sids, self.segments):
+            ntype = path[-1]
+            row = {'id': sid, 'fact_id': fids[n],
+                   'path_id': self.factset.path_id(path),
+                   'ntype': ntype, 'value': None, 'term_id': None,
+                   'int_value': None, 'verb_id': None}
+            if ntype == '_neg':
+                row['value'] = value
+            elif ntype == '_term':
+                row['term_id'] = self._term_id(value)
+            elif ntype == '_num':
+                row['int_value'] = int(value.name)
+            elif ntype == '_verb':
+                row['verb_id'] = self._term_id(value)
+            srows.append(row)
+        for table, rows in ((ptable, prows), (otable, orows),
+                            (ftable, frows), (stable, srows)):
+            if rows:
+                self.session.execute(table.insert(), rows)
+        if self.factset.wide is not None:
+            self.factset.wide.add_facts(fids, self.facts, self._term_id)
+        if self.factset.intervals:
+            self.factset.add_intervals(fids, self.facts)
+        return fids
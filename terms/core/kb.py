@@ -5,19 +5,23 @@ import json
 import multiprocessing as mp
 from multiprocessing import Process, JoinableQueue, Lock
 from multiprocessing.connection import Listener
-from threading import Thread
+from threading import Thread, Event
+from itertools import islice
+from traceback import format_exc
 
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.exc import IntegrityError
 
 from terms.core import register_exec_global
 from terms.core.terms import Term, Predicate, isa
 from terms.core.terms import ExecGlobal, load_exec_globals
 from terms.core.compiler import Compiler, Runtime
+from terms.core.retention import Retention, format_report
 from terms.core.sa import get_sasession
 from terms.core.daemon import Daemon
-from terms.core.logger import get_rlogger
+from terms.core.logger import get_rlogger, get_logger
 
-from terms.core.exceptions import TermNotFound, TermsSyntaxError, WrongLabel, IllegalLabel, WrongObjectType, ImportProblems
+from terms.core.exceptions import TermNotFound, TermsSyntaxError, WrongLabel, IllegalLabel, WrongObjectType, ImportProblems, AgendaOverflow
 
 
 class TermsJSONEncoder(json.JSONEncoder):
@@ -29,6 +33,29 @@ class TermsJSONEncoder(json.JSONEncoder):
             return super(TermsJSONEncoder, self).default(obj)
 
 
+def error_message(e):
+    '''
+    The response to the client for an error in what it told.
+    '''
+    if isinstance(e, TermNotFound):
+        return 'Unknown word: ' + e.args[0]
+    elif isinstance(e, TermsSyntaxError):
+        return 'Terms syntax error: ' + e.args[0]
+    elif isinstance(e, IllegalLabel):
+        return 'Error: labels cannot contain underscores: %s' % e.args[0]
+    elif isinstance(e, AgendaOverflow):
+        return 'Error: ' + e.args[0]
+    elif isinstance(e, IntegrityError):
+        # another teller stored the same fact concurrently
+        return 'Error: ' + str(e.orig)
+    return e.args[0]
+
+
+TELL_ERRORS = (TermNotFound, TermsSyntaxError, WrongLabel, IllegalLabel,
+               WrongObjectType, ImportProblems, AgendaOverflow,
+               IntegrityError)
+
+
 class Teller(Process):
 
     def __init__(self, config, session_factory, teller_queue, *args, **kwargs):
@@ -52,32 +79,23 @@ class Teller(Process):
                 resp = self._from_lexicon(totell)
             elif totell.startswith('compiler:exec_globals:'):
                 resp = self._add_execglobal(totell)
+            elif totell.startswith('stream:'):
+                resp = None
             else:
                 self.compiler.network.pipe = client
                 try:
                     resp = self.compiler.parse(totell)
-                except TermNotFound as e:
-                    session.rollback()
-                    resp = 'Unknown word: ' + e.args[0]
-                except TermsSyntaxError as e:
-                    session.rollback()
-                    resp = 'Terms syntax error: ' + e.args[0]
-                except WrongLabel as e:
-                    session.rollback()
-                    resp = e.args[0]
-                except IllegalLabel as e:
-                    session.rollback()
-                    resp = 'Error: labels cannot contain underscores: %s' % e.args[0]
-                except WrongObjectType as e:
+                except TELL_ERRORS as e:
                     session.rollback()
-                    resp = e.args[0]
-                except ImportProblems as e:
-                    session.rollback()
-                    resp = e.args[0]
+                    resp = error_message(e)
                 self.compiler.network.pipe = None
+                self._log_agenda()
                 resp = json.dumps(resp, cls=TermsJSONEncoder)
             try:
-                client.send_bytes(str(resp).encode('utf8'))
+                if resp is None:
+                    self._stream(client, session, totell)
+                else:
+                    client.send_bytes(str(resp).encode('utf8'))
             except BrokenPipeError:
                 pass
             else:
@@ -89,6 +107,48 @@ class Teller(Process):
         self.teller_queue.task_done()
         self.teller_queue.close()
 
+    def _log_agenda(self):
+        '''
+        Log the activations by rule of what has just been told,
+        at debug level.
+        '''
+        agenda = self.compiler.network.agenda
+        if agenda.counts:
+            get_logger().debug(agenda.report())
+
+    def _stream(self, client, session, totell):
+        '''
+        Answer a question of the form stream:<offset>:<limit>:<question>,
+        sending the matches as json lines,
+        in messages of up to stream_chunk lines.
+        A limit of 0 means no limit.
+        The matches are ordered, and the offset and the limit
+        are applied in the db, so that pages can be asked for one by one.
+        '''
+        try:
+            offset, limit, question = totell[7:].split(':', 2)
+            offset, limit = int(offset), int(limit)
+            if offset < 0 or limit < 0:
+                raise ValueError(totell)
+            limit = limit or None
+        except ValueError:
+            resp = json.dumps('Error: malformed stream header')
+            client.send_bytes((resp + '\n').encode('utf8'))
+            return
+        try:
+            matches = self.compiler.parse_question(question, offset, limit)
+            size = int(self.config['stream_chunk'])
+            while True:
+                chunk = [json.dumps(m, cls=TermsJSONEncoder) + '\n'
+                         for m in islice(matches, size)]
+                if not chunk:
+                    break
+                client.send_bytes(''.join(chunk).encode('utf8'))
+        except TELL_ERRORS as e:
+            session.rollback()
+            resp = json.dumps(error_message(e), cls=TermsJSONEncoder)
+            client.send_bytes((resp + '\n').encode('utf8'))
+
     def _from_lexicon(self, totell):
         q = totell.split(':')
         ttype = self.compiler.lexicon.get_term(q[2])
@@ -133,6 +193,10 @@ class KnowledgeBase(Daemon):
                                 self.time_lock, self.teller_queue)
             self.clock.start()
 
+        if int(self.config['past_retention']) or self.config['past_retention_verbs'].strip():
+            self.compactor = Compactor(self.config, self.session_factory)
+            self.compactor.start()
+
         host = self.config['kb_host']
         port = int(self.config['kb_port'])
         nproc = int(self.config['teller_processes'])
@@ -160,11 +224,19 @@ class KnowledgeBase(Daemon):
             self.clock.ticking = False
         except AttributeError:
             pass
+        try:
+            self.compactor.stop()
+        except AttributeError:
+            pass
         self.teller_queue.join()
         try:
             self.clock.join()
         except AttributeError:
             pass
+        try:
+            self.compactor.join()
+        except AttributeError:
+            pass
         print('bye from {n}, received signal {p}'.format(n=mp.current_process().name, p=str(signum)))
 
 
@@ -192,7 +264,7 @@ class Ticker(Thread):
             except NoResultFound:
                 pass
             else:
-                self.session.delete(fact)
+                self.compiler.network.remove_fact(fact)
                 self.session.commit()
             self.compiler.network.passtime()
             pred = Predicate(True, self.compiler.lexicon.vtime,
@@ -204,3 +276,39 @@ class Ticker(Thread):
                 time.sleep(float(self.config['instant_duration']))
             else:
                 self.session.close()
+
+
+class Compactor(Thread):
+    '''
+    Delete the expired facts in the past every compact_interval seconds.
+    It does not take the time lock, and commits every CHUNK facts,
+    so tellers are not blocked while it works.
+    A failed compaction is logged and rolled back,
+    and tried again in the next interval.
+    '''
+
+    def __init__(self, config, session_factory, *args, **kwargs):
+        super(Compactor, self).__init__(*args, **kwargs)
+        self.config = config
+        self.session_factory = session_factory
+        self.stopped = Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        interval = float(self.config['compact_interval'])
+        session = self.session_factory()
+        compiler = Compiler(session, self.config)
+        retention = Retention(compiler.network, self.config)
+        while not self.stopped.wait(interval):
+            try:
+                counts = retention.compact(commit=session.commit)
+                session.commit()
+            except Exception:
+                session.rollback()
+                print('compacting the past failed:\n' + format_exc())
+                continue
+            if counts['facts']:
+                print(format_report(counts))
+        session.close()
@@ -17,11 +17,96 @@
 # along with any part of the terms project.
 # If not, see <http://www.gnu.org/licenses/>.
 
+from collections import OrderedDict
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import Column, Integer, sql, event
+from sqlalchemy.orm import make_transient_to_detached
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 
 from terms.core import exceptions
 from terms.core import patterns
-from terms.core.terms import Term, Predicate, isa, are, Time
+from terms.core.terms import Base, Term, ObjectType, Predicate, Time
+from terms.core.terms import isa, are, get_bases, get_mask
+from terms.core.terms import term_to_base, term_to_objtype, term_ancestors
+from terms.core.factset import CHUNK, allocate_ids
+
+
+class TermsVersion(Base):
+    '''
+    A counter increased whenever a transaction
+    that adds terms is committed.
+    The term caches of all processes are checked against it.
+    '''
+    __tablename__ = 'termsversion'
+
+    id = Column(Integer, default=0, primary_key=True)
+    version = Column(Integer, default=0)
+
+
+def read_terms_version(session):
+    vtable = TermsVersion.__table__
+    return session.execute(sql.select([vtable.c.version])).scalar() or 0
+
+
+def bump_terms_version(session):
+    vtable = TermsVersion.__table__
+    q = vtable.update().values(version=vtable.c.version + 1)
+    if not session.execute(q).rowcount:
+        session.execute(vtable.insert(), [{'id': 0, 'version': 1}])
+
+
+class TermCache(object):
+    '''
+    Detached copies of the terms in the db, by name and by id,
+    with the bitmasks of their ancestors,
+    and the ids of the subterms, and of the terms of each type,
+    for the types that have been asked for them;
+    shared by all the lexicons in a process.
+    Each lexicon merges the copies into its own session
+    without querying the db.
+
+    Committed terms do not change, but new terms are new subterms
+    of their ancestors, so everything is dropped
+    when the version in the termsversion table changes.
+    '''
+
+    def __init__(self):
+        self.version = None
+        self.clear()
+
+    def clear(self):
+        self.by_name = {}
+        self.by_id = {}
+        self.subterms = {}
+        self.of_type = {}
+
+    def check(self, version):
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    def add(self, term):
+        copy = Term.__mapper__.class_manager.new_instance()
+        for prop in Term.__mapper__.column_attrs:
+            setattr(copy, prop.key, getattr(term, prop.key))
+        make_transient_to_detached(copy)
+        copy._bit = getattr(term, '_bit', None)
+        copy._sup_mask = getattr(term, '_sup_mask', None)
+        self.by_name[term.name] = copy
+        self.by_id[term.id] = copy
+
+
+_term_caches = WeakKeyDictionary()
+
+
+def get_term_cache(engine):
+    '''
+    Get the TermCache for the db behind engine.
+    '''
+    if engine not in _term_caches:
+        _term_caches[engine] = TermCache()
+    return _term_caches[engine]
 
 
 class Lexicon(object):
@@ -29,6 +114,19 @@ class Lexicon(object):
     def __init__(self, session, config):
         self.config = config
         self.session = session
+        self._term_cache = {}
+        self.terms = get_term_cache(session.bind)
+        self._checked = False
+        self._version = None
+        # increased whenever the taxonomy changes,
+        # to invalidate the subterms cached in terms
+        self.epoch = 0
+        self._added = False  # whether terms were added in this transaction
+        self._fresh = set()  # ids of the terms flushed in this transaction
+        event.listen(session, 'after_flush', self._flushed)
+        event.listen(session, 'before_commit', self._bump_version)
+        event.listen(session, 'after_commit', self._end_transaction)
+        event.listen(session, 'after_rollback', self._rollback)
         self.word = self.get_term('word')
         self.verb = self.get_term('verb')
         self.noun = self.get_term('noun')
@@ -43,7 +141,6 @@ class Lexicon(object):
         self.finish = self.get_term('finish')
         self.time = self.session.query(Time).one()
         self.now_term = self.make_term(str(0 + self.time.now), self.number)
-        self._term_cache = {}
 
     @classmethod
     def initialize(cls, session):
@@ -85,33 +182,185 @@ class Lexicon(object):
         time = Time()
         session.add(time)
         session.commit()
+        cls.rebuild_ancestors(session)
+        session.commit()
+
+    @classmethod
+    def rebuild_ancestors(cls, session):
+        '''
+        Recompute the term_ancestors closure table from term_to_base,
+        with a recursive query.
+        Return the number of rows.
+        '''
+        session.execute(term_ancestors.delete())
+        ttable, tb = Term.__table__, term_to_base
+        q = sql.select([ttable.c.id.label('term_id'),
+                        ttable.c.id.label('ancestor_id'),
+                        sql.literal(0, Integer).label('depth')])
+        q = q.where((ttable.c.var==None) | (ttable.c.var==False))
+        q = q.where((ttable.c.number==None) | (ttable.c.number==False))
+        closure = q.cte('closure', recursive=True)
+        prev = closure.alias()
+        step = sql.select([prev.c.term_id, tb.c.base_id, prev.c.depth + 1])
+        closure = closure.union(step.where(tb.c.term_id==prev.c.ancestor_id))
+        q = sql.select([closure.c.term_id, closure.c.ancestor_id,
+                        sql.func.min(closure.c.depth)])
+        q = q.group_by(closure.c.term_id, closure.c.ancestor_id)
+        names = ['term_id', 'ancestor_id', 'depth']
+        session.execute(term_ancestors.insert().from_select(names, q))
+        q = sql.select([sql.func.count()]).select_from(term_ancestors)
+        return session.execute(q).scalar()
 
     def get_term(self, name):
         '''
         Given a name (string), get a Term from the database.
         The Term must exist.
         '''
-        cache = getattr(self, '_term_cache', None)
-        if cache is not None:
-            if name in cache:
-                return cache[name]
-        else:
-            self._term_cache = {}
         try:
-            return self.session.query(Term).filter_by(name=name).one()
-        except MultipleResultsFound:
-            raise exceptions.TermRepeated(name)
-        except NoResultFound:
-            raise exceptions.TermNotFound(name)
+            return self._term_cache[name]
+        except KeyError:
+            pass
+        copy = self._get_cache().by_name.get(name)
+        if copy is not None:
+            term = self._merge(copy)
+        else:
+            try:
+                term = self.session.query(Term).filter_by(name=name).one()
+            except MultipleResultsFound:
+                raise exceptions.TermRepeated(name)
+            except NoResultFound:
+                raise exceptions.TermNotFound(name)
+            self._remember(term)
+        self._term_cache[name] = term
+        return term
+
+    def _get_cache(self):
+        '''
+        The process cache of terms,
+        checked against the version in the db once per transaction.
+        A new version also means a new taxonomy epoch.
+        '''
+        if not self._checked:
+            version = read_terms_version(self.session)
+            if version != self._version:
+                self._version = version
+                self.epoch += 1
+            self.terms.check(version)
+            self._checked = True
+        return self.terms
+
+    def _new_term(self):
+        '''
+        Start a new taxonomy epoch,
+        so that the cached subterms of all terms are rebuilt when next used,
+        and stop using the process cache for them until commit.
+        '''
+        self.epoch += 1
+        self._added = True
+
+    def _merge(self, copy):
+        '''
+        Get the term in the session for a copy in the process cache.
+        Its type is merged first,
+        so that it is lazily loaded from the identity map.
+        '''
+        ttype = self.terms.by_id.get(copy.type_id)
+        if ttype is not None and ttype is not copy:
+            self._merge(ttype)
+        term = self.session.merge(copy, load=False)
+        if getattr(term, '_sup_mask', None) is None and copy._sup_mask is not None:
+            term._bit = copy._bit
+            term._sup_mask = copy._sup_mask
+        return term
+
+    def _remember(self, term, warm=True):
+        '''
+        Keep a copy of term in the process cache,
+        unless it is not committed.
+        If warm, the bitmask of its ancestors is first computed,
+        to be kept with it.
+        Return whether it is kept.
+        '''
+        if term.id is None or term.id in self._fresh:
+            return False
+        if warm:
+            get_mask(term)
+        self.terms.add(term)
+        return True
+
+    def _flushed(self, session, context):
+        for obj in session.new:
+            if isinstance(obj, Term):
+                self._fresh.add(obj.id)
+
+    def _bump_version(self, session):
+        if self._added:
+            bump_terms_version(session)
+
+    def _end_transaction(self, session):
+        self._checked = False
+        self._added = False
+        self._fresh.clear()
+
+    def _rollback(self, session):
+        # the terms added in the rolled back transaction are gone
+        self._term_cache.clear()
+        self.epoch += 1
+        self._end_transaction(session)
 
     def get_terms(self, term_type):
         '''
         Get all terms of type term_type.
         The term_type must exist.
         '''
-        types = self.get_subterms(term_type)
-        type_ids = [t.id for t in types if t is not self.number]
-        return self.session.query(Term).filter(Term.type_id.in_(type_ids)).all()
+        return list(self.iter_terms(term_type))
+
+    def iter_terms(self, term_type):
+        '''
+        Iterate over the terms of type term_type,
+        or of any of its subtypes (except number),
+        by id.
+        They are read from the db in chunks, with a single query,
+        and the ids are kept in the process cache
+        until the version of the terms changes.
+        Vars are left out, since they are added
+        without changing the version.
+        '''
+        root = self._subterms_root(term_type)
+        if root is None:
+            return
+        cached = self._cached_terms(root)
+        if cached is not None:
+            for copy in cached:
+                yield self._merge(copy)
+            return
+        ta = term_ancestors
+        q = self.session.query(Term).join(ta, ta.c.term_id==Term.type_id)
+        q = q.filter(ta.c.ancestor_id==root.id)
+        q = q.filter(Term.type_id!=self.number.id)
+        q = q.filter((Term.var==None) | (Term.var==False)).order_by(Term.id)
+        ids, kept = [], not self._added
+        for term in q.yield_per(CHUNK):
+            if kept:
+                kept = self._remember(term, warm=False)
+                ids.append(term.id)
+            yield term
+        if kept:
+            self.terms.of_type[root.id] = tuple(ids)
+
+    def _cached_terms(self, root):
+        '''
+        The copies of the terms of type root from the process cache,
+        or None if they are not there,
+        or if terms have been added in this transaction.
+        '''
+        if self._added or root.id is None:
+            return None
+        terms = self._get_cache()
+        try:
+            return [terms.by_id[i] for i in terms.of_type[root.id]]
+        except KeyError:
+            return None
 
     def make_term(self, name, term_type, **objs):
         '''
@@ -160,34 +409,121 @@ class Lexicon(object):
     def add_term(self, name, term_type, **objs):
         term = self.make_term(name, term_type, **objs)
         self.session.add(term)
-        term.purge_cache(self)
+        self._add_ancestors(term)
         self._term_cache[name] = term
+        self._new_term()
         return term
 
     def add_subterm(self, name, super_terms, **objs):
         term = self.make_subterm(name, super_terms, **objs)
         self.session.add(term)
-        term.purge_cache(self)
+        self._add_ancestors(term)
         self._term_cache[name] = term
+        self._new_term()
         return term
 
-    def get_subterms(self, term):
-        cache = getattr(term, '_sub_cache', None)
-        if cache is not None:
-            return cache
-        name = term.name
-        m = patterns.varpat.match(name)
+    def _add_ancestors(self, term):
+        '''
+        Add the rows of a new term to the term_ancestors table:
+        the term itself, and the ancestors of its bases, one level deeper.
+        Nothing is done if the term is already in the table.
+        '''
+        self.session.flush()
+        ta = term_ancestors
+        q = sql.select([ta.c.term_id]).where(ta.c.term_id==term.id).limit(1)
+        if self.session.execute(q).first() is not None:
+            return
+        depths = {term.id: 0}
+        base_ids = [b.id for b in term.bases]
+        if base_ids:
+            q = sql.select([ta.c.ancestor_id, sql.func.min(ta.c.depth)])
+            q = q.where(ta.c.term_id.in_(base_ids)).group_by(ta.c.ancestor_id)
+            for ancestor_id, depth in self.session.execute(q):
+                depths.setdefault(ancestor_id, depth + 1)
+        rows = [{'term_id': term.id, 'ancestor_id': aid, 'depth': d}
+                for aid, d in depths.items()]
+        self.session.execute(term_ancestors.insert(), rows)
+
+    def _subterms_root(self, term):
+        '''
+        The term whose subterms are the subterms of term:
+        term itself, or, for a var, the term it ranges over.
+        None if a var has no subterms.
+        '''
+        m = patterns.varpat.match(term.name)
         if m:
             if m.group(2):
-                term = self.get_term(m.group(1).lower())
-            else:
-                return ()
-        subtypes = set([term])
-        self._recurse_subterms(term, subtypes)
-        subterms = tuple(subtypes)
-        term._sub_cache = subterms
+                return self.get_term(m.group(1).lower())
+            return None
+        return term
+
+    def get_subterms(self, term):
+        '''
+        Get term and all the terms that have it among their ancestors,
+        cached in term for the current taxonomy epoch.
+        '''
+        self._get_cache()
+        cache = getattr(term, '_sub_cache', None)
+        if cache is not None and cache[0] == self.epoch:
+            return cache[1]
+        root = self._subterms_root(term)
+        if root is None:
+            return ()
+        subterms = self._cached_subterms(root)
+        if subterms is None:
+            subtypes = set([root])
+            ta = term_ancestors
+            q = self.session.query(Term).join(ta, ta.c.term_id==Term.id)
+            subtypes.update(q.filter(ta.c.ancestor_id==root.id))
+            subterms = tuple(subtypes)
+            if not self._added and root.id is not None:
+                kept = [self._remember(t, warm=False) for t in subterms]
+                if all(kept):
+                    self.terms.subterms[root.id] = tuple(t.id for t in subterms)
+        term._sub_cache = (self.epoch, subterms)
         return subterms
 
+    def _cached_subterms(self, root):
+        '''
+        The subterms of root from the process cache,
+        or None if they are not there,
+        or if terms have been added in this transaction.
+        '''
+        if self._added or root.id is None:
+            return None
+        terms = self._get_cache()
+        try:
+            copies = [terms.by_id[i] for i in terms.subterms[root.id]]
+        except KeyError:
+            return None
+        return tuple(self._merge(c) for c in copies)
+
+    def join_subterms(self, q, col, term):
+        '''
+        Join the query q with the term_ancestors table,
+        so that col (a column with term ids)
+        only takes the ids of subterms of term.
+        '''
+        root = self._subterms_root(term)
+        if root is None:
+            return q.filter(sql.false())
+        if root.id is None:
+            return q.filter(col.in_([t.id for t in self.get_subterms(term)]))
+        ta = term_ancestors.alias()
+        return q.join(ta, (ta.c.term_id==col) & (ta.c.ancestor_id==root.id))
+
+    def join_ancestors(self, q, col, term):
+        '''
+        Join the query q with the term_ancestors table,
+        so that col (a column with term ids)
+        only takes the ids of term and its ancestors.
+        '''
+        if term.id is None or term.var:
+            types = (term,) + get_bases(term)
+            return q.filter(col.in_([t.id for t in types]))
+        ta = term_ancestors.alias()
+        return q.join(ta, (ta.c.ancestor_id==col) & (ta.c.term_id==term.id))
+
     def make_var(self, name):
         '''
         Make a term that represents a variable in a rule or query.
@@ -218,13 +554,6 @@ class Lexicon(object):
         self.session.add(var)
         return var
 
-    def _recurse_subterms(self, term, subterms):
-        for st in term.subwords:
-            if st.var:
-                continue
-            subterms.add(st)
-            self._recurse_subterms(st, subterms)
-
     def _make_noun(self, name, bases=None, ntype=None):
         if bases is None:
             bases = (self.thing,)
@@ -263,3 +592,199 @@ class Lexicon(object):
 
     def make_pred(self, true, verb_, **objs):
         return Predicate(true, verb_, **objs)
+
+
+class TermRecord(object):
+    '''
+    A term defined in a bulk of definitions, before it is written:
+    its name, its type and bases (Terms or TermRecords),
+    the names of its ancestors, and its object types.
+    '''
+    __slots__ = ('id', 'name', 'term_type', 'bases', 'ancestors', 'objtypes')
+
+    def __init__(self, name, term_type, bases):
+        self.id = None
+        self.name = name
+        self.term_type = term_type
+        self.bases = bases
+        self.ancestors = set()
+        self.objtypes = []
+
+
+class ObjTypeRecord(object):
+    '''
+    An object type of a TermRecord:
+    either an ObjectType in the db, inherited from a base,
+    or a new one, whose id is allocated when it is written.
+    '''
+    __slots__ = ('id', 'label', 'obj_type')
+
+    def __init__(self, id, label, obj_type=None):
+        self.id = id
+        self.label = label
+        self.obj_type = obj_type
+
+
+class TermWriter(object):
+    '''
+    Collect the terms defined in a run of definitions,
+    and insert them (terms, term_to_base, objecttypes and term_to_objtype
+    rows) with Core executemany's, with primary keys preallocated.
+    The terms are classified as make_term and make_subterm do,
+    resolving the names of terms defined earlier in the run,
+    and their term_ancestors rows are computed from those of their bases.
+    '''
+
+    def __init__(self, lexicon, names):
+        self.lexicon = lexicon
+        self.session = lexicon.session
+        self.records = OrderedDict()
+        self.objtypes = []
+        self.existing = set()
+        names = list(set(names))
+        for n in range(0, len(names), CHUNK):
+            q = sql.select([Term.__table__.c.name])
+            q = q.where(Term.__table__.c.name.in_(names[n:n + CHUNK]))
+            self.existing.update(row[0] for row in self.session.execute(q))
+
+    def get_term(self, name):
+        try:
+            return self.records[name]
+        except KeyError:
+            return self.lexicon.get_term(name)
+
+    def _exists(self, name):
+        return name in self.records or name in self.existing
+
+    def _are(self, term, ancestor):
+        if isinstance(term, TermRecord):
+            return ancestor.name in term.ancestors
+        return are(term, ancestor)
+
+    def _ancestors(self, term):
+        if isinstance(term, TermRecord):
+            return term.ancestors | {term.name}
+        return {t.name for t in get_bases(term)} | {term.name}
+
+    def _objtypes(self, term):
+        if isinstance(term, TermRecord):
+            return term.objtypes
+        return [ObjTypeRecord(ot.id, ot.label) for ot in term.object_types]
+
+    def add_term(self, name, term_type):
+        '''
+        Add a term given its type.
+        Return False if it is not of a kind that can be added in bulk
+        (only names of things and of nouns can).
+        '''
+        if self._exists(name):
+            return True
+        if self._are(term_type, self.lexicon.noun):
+            bases = (self.lexicon.thing,)
+        elif self._are(term_type, self.lexicon.thing):
+            bases = ()
+        else:
+            return False
+        self._add(name, term_type, bases, {})
+        return True
+
+    def add_subterm(self, name, bases, objs):
+        '''
+        Add a term given its bases, and its objects if it is a verb.
+        Return False if it is not of a kind that can be added in bulk.
+        '''
+        if self._exists(name):
+            return True
+        lexicon, base = self.lexicon, bases[0]
+        if self._are(base, lexicon.noun):
+            ttype, objs = lexicon.word, {}
+        elif self._are(base, lexicon.thing):
+            ttype, objs = lexicon.noun, {}
+        elif self._are(base, lexicon.verb):
+            ttype, objs = lexicon.word, {}
+        elif self._are(base, lexicon.exist):
+            for label in objs:
+                if '_' in label:
+                    raise exceptions.IllegalLabel(label)
+            ttype = base.term_type
+        else:
+            return False
+        self._add(name, ttype, tuple(bases), objs)
+        return True
+
+    def _add(self, name, term_type, bases, objs):
+        record = TermRecord(name, term_type, bases)
+        used = set()
+        for label, otype in objs.items():
+            objtype = ObjTypeRecord(None, label, otype)
+            self.objtypes.append(objtype)
+            record.objtypes.append(objtype)
+            used.add(label)
+        for base in bases:
+            record.ancestors |= self._ancestors(base)
+            for objtype in self._objtypes(base):
+                if objtype.label not in used:
+                    record.objtypes.append(objtype)
+                    used.add(objtype.label)
+        self.records[name] = record
+
+    def _ancestor_rows(self, records):
+        '''
+        The term_ancestors rows of the records:
+        each record, and the ancestors of its bases, one level deeper.
+        The rows of bases already in the db are read in one query,
+        those of bases in the run are computed before, in order.
+        '''
+        ta = term_ancestors
+        base_ids = list({b.id for r in records for b in r.bases
+                         if not isinstance(b, TermRecord)})
+        closures = {}
+        for n in range(0, len(base_ids), CHUNK):
+            q = sql.select([ta.c.term_id, ta.c.ancestor_id, ta.c.depth])
+            q = q.where(ta.c.term_id.in_(base_ids[n:n + CHUNK]))
+            for term_id, ancestor_id, depth in self.session.execute(q):
+                closures.setdefault(term_id, {})[ancestor_id] = depth
+        rows = []
+        for r in records:
+            depths = {r.id: 0}
+            for base in r.bases:
+                for aid, depth in closures.get(base.id, {}).items():
+                    depths[aid] = min(depths.get(aid, depth + 1), depth + 1)
+            closures[r.id] = depths
+            rows.extend({'term_id': r.id, 'ancestor_id': aid, 'depth': d}
+                        for aid, d in depths.items())
+        return rows
+
+    def write(self):
+        '''
+        Insert all collected rows, with those of the term_ancestors table.
+        '''
+        if not self.records:
+            return
+        self.session.flush()
+        ttable, otable = Term.__table__, ObjectType.__table__
+        records = list(self.records.values())
+        tids, oids = allocate_ids(self.session, (
+            (ttable, len(records)), (otable, len(self.objtypes))))
+        for record, tid in zip(records, tids):
+            record.id = tid
+        for objtype, oid in zip(self.objtypes, oids):
+            objtype.id = oid
+        trows, brows, orows, torows = [], [], [], []
+        for r in records:
+            trows.append({'id': r.id, 'name': r.name, 'type_id': r.term_type.id,
+                          'var': False, 'number': False, 'rule_id': None})
+            brows.extend({'term_id': r.id, 'base_id': b.id} for b in r.bases)
+            torows.extend({'term_id': r.id, 'objtype_id': ot.id}
+                          for ot in r.objtypes)
+        orows = [{'id': ot.id, 'label': ot.label,
+                  'obj_type_id': ot.obj_type.id} for ot in self.objtypes]
+        for table, rows in ((ttable, trows), (otable, orows),
+                            (term_to_base, brows), (term_to_objtype, torows)):
+            if rows:
+                self.session.execute(table.insert(), rows)
+        self.session.execute(term_ancestors.insert(), self._ancestor_rows(records))
+        self.lexicon._new_term()
+        self.existing.update(self.records)
+        self.records.clear()
+        self.objtypes = []
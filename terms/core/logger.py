@@ -40,3 +40,11 @@ def get_rlogger(config):
     logger.setLevel(getattr(logging, config['loglevel']))
     reader_logger = StreamToLogger(logger)
     return reader_logger
+
+
+def get_logger():
+    '''
+    The logger behind the stream returned by get_rlogger,
+    to log at levels other than INFO.
+    '''
+    return logging.getLogger(sys.argv[0])
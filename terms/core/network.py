@@ -18,21 +18,43 @@
 # If not, see <http://www.gnu.org/licenses/>.
 
 import time
-import functools
+from itertools import islice
+from collections import defaultdict, Counter
+from weakref import WeakKeyDictionary
 
-from sqlalchemy import Column, Sequence, Index
+from sqlalchemy import Column, Sequence, Index, event, true, func, inspect
 from sqlalchemy import ForeignKey, Integer, String, Boolean
-from sqlalchemy.orm import relationship, backref, aliased
+from sqlalchemy.orm import relationship, backref, aliased, joinedload
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 from sqlalchemy.exc import InvalidRequestError
 
 from terms.core import localdata
 from terms.core.terms import isa, are, get_bases
-from terms.core.terms import Base, Term, term_to_base, Predicate
+from terms.core.terms import Base, Term, term_to_base, Predicate, Object
 from terms.core.lexicon import Lexicon
-from terms.core.factset import FactSet
+from terms.core.factset import FactSet, Fact, Segment, CHUNK
 from terms.core import exceptions
-from terms.core.utils import Match, merge_submatches
+from terms.core.utils import Match, merge_submatches, match_order
+from terms.core.agenda import Agenda
+from terms.core.stats import Statistics
+from terms.core.querycache import get_query_cache, touched_verbs, bump_versions
+from terms.core.wide import WideFacts
+from terms.core.segindex import SegmentIndexFactSet
+
+
+_plan_activations = WeakKeyDictionary()
+
+
+def get_plan_activations(engine):
+    '''
+    Get the activations counted for each join plan
+    (premise id -> activations since the plan was last checked)
+    in the db behind engine.
+    They are kept for the whole process, across networks.
+    '''
+    if engine not in _plan_activations:
+        _plan_activations[engine] = defaultdict(int)
+    return _plan_activations[engine]
 
 
 class Network(object):
@@ -40,12 +62,50 @@ class Network(object):
     def __init__(self, session, config):
         self.session = session
         self.config = config
-        self.activations = []
+        self.agenda = Agenda(config)
         self.root = self.session.query(RootNode).one()
         self.lexicon = Lexicon(session, config)
-        self.present = FactSet('present', self.lexicon, config)
-        self.past = FactSet('past', self.lexicon, config)
+        self.stats = None
+        self.new_pmatches = []
+        if int(config['statistics']):
+            # the new matches must be counted before the counters are written
+            event.listen(session, 'before_commit', self.index_pending)
+            self.stats = Statistics(session)
+        self.qcache = get_query_cache(config, session.bind)
+        self.touched_verbs = set()
+        touch = None
+        if self.qcache is not None:
+            touch = self.touch_verb
+            event.listen(session, 'before_commit', self._bump_versions)
+            event.listen(session, 'after_rollback', self._forget_touched)
+        index = config['segment_index']
+        if index == 'sql':
+            factset_class = FactSet
+        elif index == 'memory':
+            factset_class = SegmentIndexFactSet
+        else:
+            raise ValueError('Unknown segment index: ' + index)
+        self.wide = None
+        if int(config['wide_facts']) and factset_class.sql:
+            self.wide = WideFacts(self.lexicon)
+        self.present = factset_class('present', self.lexicon, config,
+                               unique=True, touch=touch, wide=self.wide)
+        self.past = factset_class('past', self.lexicon, config,
+                            touch=touch, wide=self.wide,
+                            intervals=factset_class.sql)
         self.pipe = None
+        self.nodes = None
+        if int(config['node_cache']):
+            self.nodes = NodeCache(self)
+        self.beta = None
+        if int(config['beta_memory']):
+            self.beta = BetaMemory(self)
+        if self.beta is not None or self.stats is not None:
+            event.listen(session, 'after_rollback', self._forget_pmatches)
+        self.join_plans = bool(int(config['join_plans']))
+        self.plan_check = int(config['join_plan_check'])
+        self.plan_drift = float(config['join_plan_drift'])
+        self.plan_activations = get_plan_activations(session.bind)
 
     @classmethod
     def initialize(self, session):
@@ -65,16 +125,68 @@ class Network(object):
             now = int(time.time())
 
         q = self.lexicon.make_var('Occur1')
-        topast = self.present.query_facts(q, {})
-        for f in topast:
-            print('to past: ' + str(f.pred))
-            new_pred = f.pred.copy()
-            self.session.delete(f)
-            new_pred.add_object('at_', self.lexicon.now_term)
-            self.past.add_fact(new_pred)
-            self.session.flush()
+        self._to_past(self.present.fact_ids(q))
         self.now = now
 
+    def _to_past(self, rows):
+        '''
+        Move present facts, given as (fact id, pred id) rows, to the past,
+        with at_ set to the current time,
+        deleting their matches in the network.
+        This is done with a few statements for all the facts.
+        '''
+        if not rows:
+            return
+        self.session.flush()
+        self.index_pending()
+        fact_ids = [row[0] for row in rows]
+        if self.beta is not None:
+            for fact_id in fact_ids:
+                self.beta.remove_fact(fact_id)
+        if self.stats is not None:
+            self.stats.remove_pmatches(fact_ids)
+        self._delete_matches(fact_ids)
+        now = self.lexicon.now_term
+        if now.id is None:
+            self.session.add(now)
+            self.session.flush()
+        self.present.move_facts(rows, self.past, 'at_', now)
+        self._expire_moved(rows)
+
+    def _delete_matches(self, fact_ids):
+        '''
+        Delete the matches of the given facts,
+        and return a Counter with the number of deleted matches and pairs.
+        '''
+        counts = Counter()
+        pmatchs = PMatch.__table__
+        mpairs = MPair.__table__
+        for n in range(0, len(fact_ids), CHUNK):
+            chunk = fact_ids[n:n + CHUNK]
+            pmids = select([pmatchs.c.id]).where(pmatchs.c.fact_id.in_(chunk))
+            mids = select([mpairs.c.id]).where(mpairs.c.parent_id.in_(pmids))
+            for ptable in (TPair.__table__, PPair.__table__):
+                self.session.execute(ptable.delete().where(ptable.c.mid.in_(mids)))
+            r = self.session.execute(mpairs.delete().where(mpairs.c.parent_id.in_(pmids)))
+            counts['pairs'] += r.rowcount
+            r = self.session.execute(pmatchs.delete().where(pmatchs.c.fact_id.in_(chunk)))
+            counts['matches'] += r.rowcount
+        return counts
+
+    def _expire_moved(self, rows):
+        # the rows of the moved facts, their predicates and their matches
+        # have been changed behind the back of the session
+        fact_ids = {row[0] for row in rows}
+        pred_ids = {row[1] for row in rows}
+        for key, obj in list(self.session.identity_map.items()):
+            cls, ident = key[0], key[1]
+            if cls is Fact and ident[0] in fact_ids:
+                self.session.expire(obj)
+            elif cls is Predicate and ident[0] in pred_ids:
+                self.session.expire(obj, ['objects'])
+            elif cls is PMatch and inspect(obj).dict.get('fact_id') in fact_ids:
+                self.session.expunge(obj)
+
     def _get_now(self):
         return str(self.lexicon.time.now)
 
@@ -118,6 +230,81 @@ class Network(object):
         mapper = Node.__mapper__
         return mapper.base_mapper.polymorphic_map[ntype].class_
 
+    def get_root(self):
+        '''
+        The root of the primary network,
+        taken from the node cache if there is one.
+        '''
+        if self.nodes is not None:
+            return self.nodes.root
+        return self.root
+
+    def touch_verb(self, verb):
+        '''
+        Invalidate the cached answers that may depend
+        on facts with the given verb.
+        '''
+        verb_ids = touched_verbs(verb)
+        self.qcache.invalidate(verb_ids)
+        self.touched_verbs.update(verb_ids)
+
+    def _bump_versions(self, session):
+        if self.touched_verbs:
+            bump_versions(session, self.touched_verbs)
+            self.touched_verbs.clear()
+
+    def _forget_touched(self, session):
+        # answers computed in the transaction may have seen rolled back facts
+        self.qcache.clear()
+        self.touched_verbs.clear()
+
+    def count_matches(self, pnode):
+        '''
+        The number of matches of a premise node.
+        '''
+        if self.beta is not None:
+            return self.beta.count(pnode)
+        if self.stats is not None:
+            self.index_pending()
+            return self.stats.count_prem(pnode.id)
+        return pnode.matches.count()
+
+    def index_pmatch(self, pmatch):
+        '''
+        Register a new match in the beta memory and statistics.
+        This is deferred until they are next read,
+        so that the new matches are flushed together.
+        '''
+        if self.beta is None and self.stats is None:
+            return
+        self.new_pmatches.append(pmatch)
+
+    def index_pending(self, *args):
+        if not self.new_pmatches:
+            return
+        self.session.flush()
+        pmatches, self.new_pmatches = self.new_pmatches, []
+        for pmatch in pmatches:
+            if self.beta is not None:
+                self.beta.add(pmatch)
+            if self.stats is not None:
+                pairs = [(p.var, 1 if isinstance(p, PPair) else 0, p.val.id)
+                         for p in pmatch.pairs]
+                self.stats.add_pmatch(pmatch.prem_id, pairs)
+
+    def _forget_pmatches(self, *args):
+        self.new_pmatches = []
+
+    def forget_premnode(self, pnode):
+        '''
+        Drop the beta memory and statistics of a premise node
+        that is going to be deleted.
+        '''
+        if self.beta is not None:
+            self.beta.forget(pnode.id)
+        if self.stats is not None:
+            self.stats.forget_prem(pnode.id)
+
     def add_fact(self, pred):
         factset = self.present
         if isa(pred, self.lexicon.exclusive_endure):
@@ -136,54 +323,233 @@ class Network(object):
         #if contradiction:
         #    raise exceptions.Contradiction('we already have ' + str(neg))
 
-        facts = factset.query_facts(pred, {})
-        if facts.count() == 0:
+        fact = factset.get_fact(pred)
+        if fact is None:
             if isa(pred, self.lexicon.endure):
                 pred.add_object('since_', self.lexicon.now_term)
             fact = factset.add_fact(pred)
             if isa(pred, self.lexicon.happen):
                 if self.pipe is not None:
                     self.pipe.send_bytes(str(pred).encode('utf8'))
-            if self.root.child_path:
+            if self.get_root().child_path:
                 m = Match(pred)
                 m.paths = self.get_paths(pred)
                 m.fact = fact
-                Node.dispatch(self.root, m, self)
-            n = 0
-            while self.activations:
+                Node.dispatch(self.get_root(), m, self)
+            self.run_activations()
+        return fact
+
+    def add_facts(self, preds):
+        '''
+        Add a batch of facts.
+        Duplicates are checked for the whole batch in one pass,
+        the new facts are inserted in bulk,
+        and they are dispatched together through the network,
+        level by level.
+        Facts that finish other facts (exclusive-endure or finish)
+        are added one by one, in order, with add_fact.
+        Return the new facts.
+        '''
+        facts, batch = [], []
+        for pred in preds:
+            if (isa(pred, self.lexicon.exclusive_endure) or
+                    isa(pred, self.lexicon.finish)):
+                facts.extend(self._add_batch(batch))
+                batch = []
+                facts.append(self.add_fact(pred))
+            else:
+                batch.append(pred)
+        facts.extend(self._add_batch(batch))
+        return facts
+
+    def _add_batch(self, preds):
+        if not preds:
+            return []
+        factset = self.present
+        preds = factset.filter_new(preds)
+        for pred in preds:
+            if isa(pred, self.lexicon.endure):
+                pred.add_object('since_', self.lexicon.now_term)
+        facts = factset.add_facts(preds)
+        if self.pipe is not None:
+            for pred in preds:
+                if isa(pred, self.lexicon.happen):
+                    self.pipe.send_bytes(str(pred).encode('utf8'))
+        if facts and self.get_root().child_path:
+            matches = []
+            for fact in facts:
+                m = Match(fact.pred)
+                m.paths = self.get_paths(fact.pred)
+                m.fact = fact
+                matches.append(m)
+            Node.dispatch_batch(self.get_root(), matches, self)
+        self.run_activations(max(len(facts), 1))
+        return facts
+
+    def run_activations(self, facts=1):
+        '''
+        Dispatch the activations produced by the rules
+        for the given number of new facts,
+        until there are none left.
+        '''
+        self.agenda.facts = facts
+        n = 0
+        cmc = int(self.config['commit_many_consecuences'])
+        try:
+            while self.agenda:
                 n += 1
-                cmc = int(self.config['commit_many_consecuences'])
                 if cmc and n % cmc == 0:
                     self.session.commit()
-                match = self.activations.pop(0)
-                Node.dispatch(self.root, match, self)
-            return fact
-        else:
-            return facts.first()
+                match = self.agenda.pop()
+                Node.dispatch(self.get_root(), match, self)
+        finally:
+            self.agenda.reset()
 
     def finish(self, predicate):
-        fs = self.present.query_facts(predicate, {})
-        for f in fs:
-            if isa(f.pred, self.lexicon.endure):
-                print('finish: ' + str(f.pred))
-                new_pred = f.pred.copy()
-                self.session.delete(f)
-                new_pred.add_object('at_', self.lexicon.now_term)
-                self.past.add_fact(new_pred)
-                self.session.flush()
+        endure = self.lexicon.get_subterms(self.lexicon.endure)
+        verbs = {verb.id for verb in endure}
+        self._to_past(self.present.fact_ids(predicate, verbs=verbs))
 
     def del_fact(self, pred):
         fact = self.present.query_facts(pred, {}).one()
+        self.remove_fact(fact)
+
+    def remove_fact(self, fact):
+        '''
+        Delete a fact, with its matches in the network.
+        '''
+        self.index_pending()
+        if self.beta is not None:
+            self.beta.remove_fact(fact.id)
+        if self.stats is not None:
+            self.stats.remove_pmatches([fact.id])
+        if self.qcache is not None:
+            self.touch_verb(fact.pred.term_type)
+        if self.wide is not None:
+            self.wide.remove_fact(fact)
+        if fact.factset == self.past.name:
+            self.past.forget_fact(fact)
+        else:
+            self.present.forget_fact(fact)
         self.session.delete(fact)
 
+    def remove_facts(self, factset, rows):
+        '''
+        Delete many facts of factset, given as (fact id, pred id) rows,
+        with their predicates, segments and matches in the network,
+        with a few statements for every CHUNK facts.
+        Return a Counter with the number of deleted rows of each kind.
+        '''
+        if not rows:
+            return Counter()
+        self.session.flush()
+        self.index_pending()
+        fact_ids = [row[0] for row in rows]
+        verbs = factset.get_verbs([row[1] for row in rows])
+        if self.beta is not None:
+            for fact_id in fact_ids:
+                self.beta.remove_fact(fact_id)
+        if self.stats is not None:
+            self.stats.remove_pmatches(fact_ids)
+        counts = self._delete_matches(fact_ids)
+        for verb in verbs:
+            if self.wide is not None:
+                self.wide.remove_facts(verb, fact_ids)
+            if self.qcache is not None:
+                self.touch_verb(verb)
+        factset.forget_facts(fact_ids)
+        ftable = Fact.__table__
+        stable = Segment.__table__
+        for n in range(0, len(fact_ids), CHUNK):
+            chunk = fact_ids[n:n + CHUNK]
+            r = self.session.execute(stable.delete().where(stable.c.fact_id.in_(chunk)))
+            counts['segments'] += r.rowcount
+            r = self.session.execute(ftable.delete().where(ftable.c.id.in_(chunk)))
+            counts['facts'] += r.rowcount
+        pred_ids = self._own_preds([row[1] for row in rows])
+        otable = Object.__table__
+        ptable = Predicate.__table__
+        for n in range(0, len(pred_ids), CHUNK):
+            chunk = pred_ids[n:n + CHUNK]
+            r = self.session.execute(otable.delete().where(otable.c.parent_id.in_(chunk)))
+            counts['objects'] += r.rowcount
+            r = self.session.execute(ptable.delete().where(ptable.c.id.in_(chunk)))
+            counts['predicates'] += r.rowcount
+        self._expunge_removed(set(fact_ids), set(pred_ids))
+        return counts
+
+    def _own_preds(self, pred_ids):
+        '''
+        The ids of the predicates in the trees of the given predicates
+        (of facts that have been deleted)
+        that are not referenced from outside those trees,
+        by other facts, by matches, or by rules,
+        and so can be deleted with them.
+        '''
+        otable = Object.__table__
+        ptable = Predicate.__table__
+        tree = set(pred_ids)
+        children = defaultdict(list)
+        new = list(pred_ids)
+        while new:
+            found = []
+            for n in range(0, len(new), CHUNK):
+                chunk = new[n:n + CHUNK]
+                q = select([otable.c.parent_id, otable.c.pred_id])
+                q = q.where(otable.c.parent_id.in_(chunk) & (otable.c.pred_id!=None))
+                for parent_id, pred_id in self.session.execute(q):
+                    children[parent_id].append(pred_id)
+                    if pred_id not in tree:
+                        tree.add(pred_id)
+                        found.append(pred_id)
+            new = found
+        kept = set()
+        ids = list(tree)
+        for n in range(0, len(ids), CHUNK):
+            chunk = ids[n:n + CHUNK]
+            for col, where in ((Fact.__table__.c.pred_id, None),
+                               (PPair.__table__.c.pred_id, None),
+                               (Premise.__table__.c.pred_id, None),
+                               (ptable.c.id, ptable.c.rule_id!=None)):
+                q = select([col]).where(col.in_(chunk))
+                if where is not None:
+                    q = q.where(where)
+                kept.update(row[0] for row in self.session.execute(q))
+            q = select([otable.c.parent_id, otable.c.pred_id])
+            for parent_id, pred_id in self.session.execute(q.where(otable.c.pred_id.in_(chunk))):
+                if parent_id not in tree:
+                    kept.add(pred_id)
+        stack = list(kept)
+        while stack:
+            for pred_id in children[stack.pop()]:
+                if pred_id not in kept:
+                    kept.add(pred_id)
+                    stack.append(pred_id)
+        return sorted(tree - kept)
+
+    def _expunge_removed(self, fact_ids, pred_ids):
+        # the rows of these objects have been deleted behind the back of the session
+        for key, obj in list(self.session.identity_map.items()):
+            cls, ident = key[0], key[1]
+            if cls is Fact and ident[0] in fact_ids:
+                self.session.expunge(obj)
+            elif cls is Predicate and ident[0] in pred_ids:
+                self.session.expunge(obj)
+            elif cls is Object and inspect(obj).dict.get('parent_id') in pred_ids:
+                self.session.expunge(obj)
+            elif cls in (PMatch, Segment) and inspect(obj).dict.get('fact_id') in fact_ids:
+                self.session.expunge(obj)
+
     def add_rule(self, prems, conds, condcode, cons):
         rule = Rule()
+        touched = [self.root]
         for n, pred in enumerate(prems):
             vars = {}
             paths = self.get_paths(pred)
             old_node = self.root
             for path in paths:
                 old_node = self.get_or_create_node(old_node, pred, path, vars, rule)
+                touched.append(old_node)
             if old_node.terminal:
                 pnode = old_node.terminal
             else:
@@ -193,6 +559,13 @@ class Network(object):
             rule.prems.append(premise)
             for n, varname in vars.values():
                 rule.pvars.append(PVarname(premise, n, varname))
+        if self.join_plans:
+            self.session.add(rule)
+            self.session.flush()
+        if self.nodes is not None:
+            self.session.flush()
+            for node in touched:
+                self.nodes.add_node(node)
         rule.conditions = conds
         rule.condcode = condcode
         for con in cons:
@@ -210,27 +583,195 @@ class Network(object):
                     for var, val in match.items():
                         numvar = prem.name_to_num(var)
                         m.pairs.append(MPair.make_pair(numvar, val))
+                    self.index_pmatch(m)
                 prem.dispatch(match, self)
+        if self.join_plans:
+            # plans made while the matches were being indexed are partial
+            for prem in rule.prems:
+                prem.plan = []
         return rule
 
 
     def query(self, *q):
-        submatches = []
-        for pred in q:
-            factset = self.present
-            if set(pred.objects).intersection({'at_', 'till_'}):
-                factset = self.past
-            smatches = factset.query(pred)
-            submatches.append(smatches)
-        matches = merge_submatches(submatches)
-        unique = []
+        return list(self.iter_query(*q))
+
+    def iter_query(self, *q, offset=None, limit=None):
+        '''
+        Iterate over the distinct matches
+        for the conjunction of the predicates in q.
+        With an offset or a limit, the matches are ordered
+        by the values of their vars, so that an answer can be taken
+        page by page. With the factsets in sql, the offset and the limit
+        go in the query; with the segment index in memory,
+        the skipped matches are still built, and dropped in python.
+        '''
+        if offset is not None or limit is not None:
+            return self._iter_page(q, offset or 0, limit)
+        if self.qcache is not None and q:
+            return self.qcache.cached(self.session, q,
+                                      lambda: self._iter_query(q))
+        return self._iter_query(q)
+
+    def _iter_query(self, q):
+        if len(q) > 1 and not self.present.sql:
+            submatches = [self._get_factset(pred).query(pred) for pred in q]
+            matches = merge_submatches(submatches)
+        elif len(q) > 1:
+            matches = self._query_joined(q)
+        elif q:
+            matches = self._get_factset(q[0]).iter_query(q[0])
+        else:
+            matches = ()
+        seen = set()
         for m in matches:
-            for m2 in unique:
-                if m2 == m:
-                    break
-            else:
-                unique.append(m)
-        return unique
+            key = frozenset(m.items())
+            if key not in seen:
+                seen.add(key)
+                yield m
+
+    def _iter_page(self, q, offset, limit):
+        if not q:
+            return iter(())
+        if self.present.sql:
+            return self._query_joined(q, offset=offset, limit=limit)
+        matches = sorted(self._iter_query(q), key=match_order)
+        return islice(matches, offset, limit and offset + limit)
+
+    def _get_factset(self, pred):
+        if set(pred.objects).intersection({'at_', 'till_'}):
+            return self.past
+        return self.present
+
+    def _build_query(self, q):
+        '''
+        Build a single SQL query for a conjunction of predicates,
+        joining an alias of Fact for each predicate,
+        with the vars shared among them joined on equality.
+        Return the query, the taken vars,
+        and, for each alias that binds some var first,
+        a tuple with the alias, its factset, and the names of the vars
+        (or just the first alias, if there are no vars).
+        '''
+        facts = [aliased(Fact) for pred in q]
+        qfacts = self.session.query(facts[0]).select_from(facts[0])
+        taken_vars = {}
+        owners = []
+        for n, (fact, pred) in enumerate(zip(facts, q)):
+            if n > 0:
+                qfacts = qfacts.join(fact, true())
+            factset = self._get_factset(pred)
+            old_vars = set(taken_vars)
+            qfacts = factset.query_facts(pred, taken_vars,
+                                         qfacts=qfacts, fact=fact)
+            names = [name for name in taken_vars if name not in old_vars]
+            if names:
+                owners.append((fact, factset, names))
+        if not owners:
+            owners.append((facts[0], None, []))
+        return qfacts, taken_vars, owners
+
+    def query_exists(self, *q):
+        '''
+        Whether there are any matches for the conjunction of q,
+        asked to the db with EXISTS.
+        '''
+        if not self.present.sql:
+            return any(True for m in self._iter_query(q))
+        qfacts = self._build_query(q)[0]
+        return self.session.query(qfacts.exists()).scalar()
+
+    def query_count(self, *q):
+        '''
+        The number of distinct matches for the conjunction of q,
+        counted in the db.
+        '''
+        if not self.present.sql:
+            return sum(1 for m in self._iter_query(q))
+        qfacts, taken_vars, owners = self._build_query(q)
+        if not taken_vars:
+            return int(self.session.query(qfacts.exists()).scalar())
+        cols = [b[1] for b in self._bindings(taken_vars, owners)]
+        bindings = qfacts.with_entities(*cols).distinct().subquery()
+        return self.session.query(func.count()).select_from(bindings).scalar()
+
+    def _bindings(self, taken_vars, owners):
+        '''
+        For each var taken in a joined query,
+        a tuple with its name, the column that binds it,
+        the kind of value the column refers to
+        ('term', 'num' or 'fact'), and the factset and path
+        needed to resolve it from the fact, if it is a predicate.
+        '''
+        bindings = []
+        for fact, factset, names in owners:
+            for name in names:
+                path, salias = taken_vars[name]
+                ntype = path[-1]
+                if ntype == '_term':
+                    bindings.append((name, salias.term_id, 'term', None, None))
+                elif ntype == '_num':
+                    bindings.append((name, salias.int_value, 'num', None, None))
+                elif 'Verb' in name[1:]:
+                    bindings.append((name, salias.verb_id, 'term', None, None))
+                else:  # bound to the predicate at path in the fact
+                    bindings.append((name, fact.id, 'fact', factset, path))
+        return bindings
+
+    def _query_joined(self, q, offset=None, limit=None):
+        '''
+        Iterate over the matches for a conjunction of predicates,
+        selecting only the columns that bind the vars,
+        and loading what they refer to CHUNK rows at a time,
+        with a single IN query for each kind of value.
+        With an offset or a limit, the rows are ordered by those columns,
+        and only the rows asked for are taken from the db.
+        '''
+        qfacts, taken_vars, owners = self._build_query(q)
+        bindings = self._bindings(taken_vars, owners)
+        cols = [b[1] for b in bindings] or [true()]
+        qfacts = qfacts.with_entities(*cols).distinct()
+        if offset is not None or limit is not None:
+            qfacts = qfacts.order_by(*cols).offset(offset).limit(limit)
+        rows = []
+        for row in qfacts.yield_per(CHUNK):
+            rows.append(row)
+            if len(rows) == CHUNK:
+                yield from self._load_bindings(rows, bindings)
+                rows = []
+        yield from self._load_bindings(rows, bindings)
+
+    def _load_bindings(self, rows, bindings):
+        ids = {'term': set(), 'num': set(), 'fact': set()}
+        for row in rows:
+            for value, binding in zip(row, bindings):
+                ids[binding[2]].add(value)
+        values = {'term': {}, 'num': {}, 'fact': {}}
+        if ids['term']:
+            terms = self.session.query(Term).filter(Term.id.in_(ids['term']))
+            values['term'] = {t.id: t for t in terms}
+        if ids['num']:
+            names = [str(n) for n in ids['num']]
+            numbers = self.session.query(Term).filter(
+                Term.type_id==self.lexicon.number.id, Term.name.in_(names))
+            values['num'] = {t.name: t for t in numbers}
+        if ids['fact']:
+            facts = self.session.query(Fact).options(joinedload(Fact.pred))
+            facts = facts.filter(Fact.id.in_(ids['fact']))
+            values['fact'] = {f.id: f for f in facts}
+        for row in rows:
+            match = Match(None)
+            for value, (name, col, kind, factset, path) in zip(row, bindings):
+                if kind == 'fact':
+                    fact = values['fact'][value]
+                    match[name] = factset.resolve_var(fact, name, path)
+                elif kind == 'num':
+                    number = values['num'].get(str(value))
+                    if number is None:
+                        number = self.lexicon.make_number(value)
+                    match[name] = number
+                else:
+                    match[name] = values[kind][value]
+            yield match
 
     def get_or_create_node(self, parent, term, path, vars, rule):
         ntype_name = path[-1]
@@ -314,6 +855,9 @@ class Node(Base):
 
     child_path = property(_get_path, _set_path)
 
+    def value_exists(self, network):
+        return isa(self.value, network.lexicon.exist)
+
     @classmethod
     def resolve(cls, pred, path):
         '''
@@ -331,13 +875,16 @@ class Node(Base):
             ntype_name = path[-1]
             chcls = network._get_nclass(ntype_name)
             value = chcls.resolve(match.pred, path)
-            children = chcls.get_children(parent, value, network)
+            if network.nodes is not None:
+                children = network.nodes.get_children(chcls, parent, value)
+            else:
+                children = chcls.get_children(parent, value, network)
             for ch in children:
                 for child in ch:
                     new_match = match.copy()
                     if child.var:
                         val = None
-                        if chcls is VerbNode and isa(child.value, network.lexicon.exist):
+                        if chcls is VerbNode and child.value_exists(network):
                             val = TermNode.resolve(match.pred, path)
                         else:
                             val = value
@@ -350,6 +897,51 @@ class Node(Base):
         if parent.terminal:
             parent.terminal.dispatch(match, network)
 
+    @classmethod
+    def dispatch_batch(cls, parent, matches, network):
+        '''
+        Dispatch many matches at once.
+        The children of each node are looked up once
+        for each distinct value in the batch,
+        and the batch proceeds to the next level together.
+        '''
+        if parent.child_path:
+            path = parent.child_path
+            ntype_name = path[-1]
+            chcls = network._get_nclass(ntype_name)
+            groups = {}
+            for match in matches:
+                value = chcls.resolve(match.pred, path)
+                groups.setdefault(value, []).append(match)
+            for value, vmatches in groups.items():
+                if network.nodes is not None:
+                    children = network.nodes.get_children(chcls, parent, value)
+                else:
+                    children = chcls.get_children(parent, value, network)
+                for ch in children:
+                    for child in ch:
+                        new_matches = []
+                        for match in vmatches:
+                            new_match = match.copy()
+                            if child.var:
+                                val = None
+                                if chcls is VerbNode and child.value_exists(network):
+                                    val = TermNode.resolve(match.pred, path)
+                                else:
+                                    val = value
+                                if child.var in match and match[child.var] != val:
+                                    continue
+                                new_match[child.var] = val
+                            if chcls is VerbNode and child.redundant_var:
+                                new_match[child.redundant_var] = TermNode.resolve(match.pred, path)
+                            new_matches.append(new_match)
+                        if new_matches:
+                            chcls.dispatch_batch(child, new_matches, network)
+        terminal = parent.terminal
+        if terminal:
+            for match in matches:
+                terminal.dispatch(match, network)
+
     @classmethod
     def get_children(cls, parent, value, factset):
         '''
@@ -425,17 +1017,15 @@ class TermNode(Node):
 
     @classmethod
     def get_children(cls, parent, value, network):
-        if isa(value, network.lexicon.exist):
-            types = (value.term_type.term_type,) + get_bases(value.term_type.term_type)
-            type_ids = [t.id for t in types]
-            return network.session.query(cls).filter(cls.parent_id==parent.id, Node.var>0).join(Term, cls.term_id==Term.id).filter(Term.type_id.in_(type_ids)),
+        lexicon = network.lexicon
+        if isa(value, lexicon.exist):
+            vchildren = network.session.query(cls).filter(cls.parent_id==parent.id, Node.var>0).join(Term, cls.term_id==Term.id)
+            return lexicon.join_ancestors(vchildren, Term.type_id, value.term_type.term_type),
         children = network.session.query(cls).filter(cls.parent_id==parent.id, (cls.value==value) | (cls.value==None))
         vchildren = ()
         if value is not None:
-            types = (value.term_type,) + get_bases(value.term_type)
-            type_ids = [t.id for t in types]
-            if type_ids:
-                vchildren = network.session.query(cls).filter(cls.parent_id==parent.id).join(Term, cls.term_id==Term.id).filter(Term.var==True).filter(Term.type_id.in_(type_ids))
+            vchildren = network.session.query(cls).filter(cls.parent_id==parent.id).join(Term, cls.term_id==Term.id).filter(Term.var==True)
+            vchildren = lexicon.join_ancestors(vchildren, Term.type_id, value.term_type)
 #         if not isa(value, network.lexicon.thing) and not isa(value, network.lexicon.number):
 #             bases = (value,) + get_bases(value)
 #             tbases = aliased(Term)
@@ -471,12 +1061,251 @@ class VerbNode(Node):
         children = network.session.query(cls).filter(cls.parent_id==parent.id, (cls.value==value) | (cls.value==None))
         pchildren, vchildren = [], []
         if value is not None:
-            types = (value,) + get_bases(value)
-            type_ids = [t.id for t in types]
+            lexicon = network.lexicon
             chvars = network.session.query(cls).filter(cls.parent_id==parent.id, Node.var>0)
-            pchildren = chvars.join(Term, cls.verb_id==Term.id).filter(Term.type_id.in_(type_ids))
-            tbases = aliased(Term)
-            vchildren = chvars.join(Term, cls.verb_id==Term.id).join(term_to_base, Term.id==term_to_base.c.term_id).join(tbases, term_to_base.c.base_id==tbases.id).filter(tbases.id.in_(type_ids))
+            pchildren = chvars.join(Term, cls.verb_id==Term.id)
+            pchildren = lexicon.join_ancestors(pchildren, Term.type_id, value)
+            vchildren = chvars.join(Term, cls.verb_id==Term.id).join(term_to_base, Term.id==term_to_base.c.term_id)
+            vchildren = lexicon.join_ancestors(vchildren, term_to_base.c.base_id, value)
+        return children, pchildren, vchildren
+
+
+class CachedNode(object):
+    '''
+    A plain copy of a node in the primary network,
+    as kept by the node cache.
+    '''
+    __slots__ = ('cache', 'id', 'parent_id', 'ntype', 'var', 'redundant_var',
+                 'value', 'value_type', 'value_var', 'value_bases',
+                 'exists', 'child_path', 'terminal_id')
+
+    def __init__(self, cache, id, parent_id, ntype):
+        self.cache = cache
+        self.id = id
+        self.parent_id = parent_id
+        self.ntype = ntype
+        self.var = 0
+        self.redundant_var = 0
+        self.value = None
+        self.value_type = None
+        self.value_var = False
+        self.value_bases = ()
+        self.exists = False
+        self.child_path = ()
+        self.terminal_id = None
+
+    def value_exists(self, network):
+        return self.exists
+
+    @property
+    def terminal(self):
+        if self.terminal_id is None:
+            return None
+        return self.cache.network.session.query(PremNode).get(self.terminal_id)
+
+
+class NodeCache(object):
+    '''
+    An in-process index of the primary network,
+    so that dispatching a match through it
+    does not need to query the nodes tables.
+    It is loaded from the db the first time it is used,
+    and kept in sync with the nodes added by add_rule
+    and removed by instant rules.
+    It is dropped on rollback, and loaded again when next used.
+    '''
+
+    def __init__(self, network):
+        self.network = network
+        self.loaded = False
+        self.nodes = {}
+        self.children = defaultdict(list)  # parent id -> nodes
+        # all keyed by (parent id, ntype, ...)
+        self.by_value = defaultdict(list)  # value -> nodes
+        self.by_type = defaultdict(list)  # type of the var value -> nodes
+        self.by_base = defaultdict(list)  # base of the var value -> nodes
+        self._exist_types = {}
+        event.listen(network.session, 'after_rollback', self.clear)
+
+    def clear(self, *args):
+        self.loaded = False
+        self.nodes = {}
+        self.children.clear()
+        self.by_value.clear()
+        self.by_type.clear()
+        self.by_base.clear()
+        self._exist_types.clear()
+
+    @property
+    def root(self):
+        if not self.loaded:
+            self.load()
+        return self.nodes[self.network.root.id]
+
+    def load(self):
+        session = self.network.session
+        session.flush()
+        nodes = Node.__table__
+        negs = NegNode.__table__
+        tnodes = TermNode.__table__
+        vnodes = VerbNode.__table__
+        pnodes = PremNode.__table__
+        terms = Term.__table__
+        from_obj = nodes.outerjoin(negs, negs.c.nid==nodes.c.id)
+        from_obj = from_obj.outerjoin(tnodes, tnodes.c.nid==nodes.c.id)
+        from_obj = from_obj.outerjoin(vnodes, vnodes.c.nid==nodes.c.id)
+        from_obj = from_obj.outerjoin(terms, (terms.c.id==tnodes.c.term_id) | (terms.c.id==vnodes.c.verb_id))
+        from_obj = from_obj.outerjoin(pnodes, pnodes.c.parent_id==nodes.c.id)
+        q = select([nodes.c.id, nodes.c.parent_id, nodes.c.ntype,
+                    nodes.c.var, nodes.c.redundant_var,
+                    nodes.c.child_path_str, negs.c.value,
+                    tnodes.c.term_id, vnodes.c.verb_id,
+                    terms.c.type_id, terms.c.var, pnodes.c.id],
+                   from_obj=[from_obj])
+        bases = defaultdict(list)
+        qbases = select([vnodes.c.nid, term_to_base.c.base_id],
+                        from_obj=[vnodes.join(term_to_base,
+                                  term_to_base.c.term_id==vnodes.c.verb_id)])
+        for nid, base_id in session.execute(qbases):
+            bases[nid].append(base_id)
+        self.clear()
+        for row in session.execute(q):
+            (nid, parent_id, ntype, var, rvar, path, neg, term_id, verb_id,
+             type_id, value_var, terminal_id) = row
+            node = CachedNode(self, nid, parent_id, ntype)
+            node.var = var or 0
+            node.redundant_var = rvar or 0
+            node.child_path = tuple(path.split('.')) if path else ()
+            node.terminal_id = terminal_id
+            if ntype == '_neg':
+                node.value = neg
+            elif ntype == '_term':
+                node.value = term_id
+            elif ntype == '_verb':
+                node.value = verb_id
+                node.value_bases = tuple(bases[nid])
+            if node.value is not None and ntype != '_neg':
+                node.value_type = type_id
+                node.value_var = bool(value_var)
+                if ntype == '_verb':
+                    node.exists = self._is_exist(type_id)
+            self._index(node)
+        self.loaded = True
+
+    def _is_exist(self, type_id):
+        if type_id not in self._exist_types:
+            ttype = self.network.session.query(Term).get(type_id)
+            self._exist_types[type_id] = are(ttype, self.network.lexicon.exist)
+        return self._exist_types[type_id]
+
+    def _index(self, node):
+        self.nodes[node.id] = node
+        if node.parent_id is None:
+            return
+        self.children[node.parent_id].append(node)
+        self.by_value[(node.parent_id, node.ntype, node.value)].append(node)
+        if node.var or node.value_var:
+            self.by_type[(node.parent_id, node.ntype, node.value_type)].append(node)
+            for base_id in node.value_bases:
+                self.by_base[(node.parent_id, node.ntype, base_id)].append(node)
+
+    def _unindex(self, node):
+        del self.nodes[node.id]
+        self.children.pop(node.id, None)
+        if node.parent_id is None:
+            return
+        siblings = self.children.get(node.parent_id)
+        if siblings is not None:
+            siblings.remove(node)
+        self.by_value[(node.parent_id, node.ntype, node.value)].remove(node)
+        if node.var or node.value_var:
+            self.by_type[(node.parent_id, node.ntype, node.value_type)].remove(node)
+            for base_id in node.value_bases:
+                self.by_base[(node.parent_id, node.ntype, base_id)].remove(node)
+
+    def add_node(self, node):
+        '''
+        Add a (flushed) node to the cache,
+        or refresh its child path and terminal if it is already there.
+        '''
+        if not self.loaded:
+            return
+        cached = self.nodes.get(node.id)
+        if cached is None:
+            cached = CachedNode(self, node.id, node.parent_id, node.ntype)
+            cached.var = node.var or 0
+            cached.redundant_var = node.redundant_var or 0
+            value = node.value
+            if isinstance(node, NegNode):
+                cached.value = value
+            elif value is not None:
+                cached.value = value.id
+                cached.value_type = value.type_id
+                cached.value_var = bool(value.var)
+                if isinstance(node, VerbNode):
+                    cached.value_bases = tuple(b.id for b in value.bases)
+                    cached.exists = isa(value, self.network.lexicon.exist)
+            self._index(cached)
+        cached.child_path = node.child_path
+        cached.terminal_id = node.terminal.id if node.terminal else None
+
+    def remove_node(self, node):
+        '''
+        Remove a node and all its descendants from the cache.
+        '''
+        if not self.loaded:
+            return
+        cached = self.nodes.get(node.id)
+        if cached is None:
+            return
+        remove = [cached]
+        while remove:
+            cached = remove.pop()
+            remove.extend(self.children.get(cached.id, ()))
+            self._unindex(cached)
+
+    def get_children(self, cls, parent, value):
+        '''
+        The same as the get_children classmethods of the node classes,
+        but looking up the children in the cache.
+        '''
+        pid = parent.id
+        ntype = cls.__mapper_args__['polymorphic_identity']
+        nulls = self.by_value.get((pid, ntype, None), [])
+        if cls is NegNode:
+            if value is None:
+                return [nulls]
+            return [self.by_value.get((pid, ntype, value), []) + nulls]
+        value_id = getattr(value, 'id', None)
+        if value is None or value_id is None:
+            children = nulls
+        else:
+            children = self.by_value.get((pid, ntype, value_id), []) + nulls
+        if cls is TermNode:
+            if isa(value, self.network.lexicon.exist):
+                types = (value.term_type.term_type,) + get_bases(value.term_type.term_type)
+                return [[n for t in types
+                           for n in self.by_type.get((pid, ntype, t.id), ())
+                           if n.var > 0]]
+            vchildren = []
+            if value is not None:
+                types = (value.term_type,) + get_bases(value.term_type)
+                vchildren = [n for t in types
+                               for n in self.by_type.get((pid, ntype, t.id), ())
+                               if n.value_var]
+            return children, vchildren
+        pchildren, vchildren = [], []
+        if value is not None:
+            types = (value,) + get_bases(value)
+            pchildren = [n for t in types
+                           for n in self.by_type.get((pid, ntype, t.id), ())
+                           if n.var > 0]
+            seen = set()
+            for t in types:
+                for n in self.by_base.get((pid, ntype, t.id), ()):
+                    if n.var > 0 and n.id not in seen:
+                        seen.add(n.id)
+                        vchildren.append(n)
         return children, pchildren, vchildren
 
 
@@ -501,12 +1330,12 @@ class PremNode(Base):
         m = PMatch(self, match.fact)
         for var, val in match.items():
             m.pairs.append(MPair.make_pair(var, val))
+        network.index_pmatch(m)
         for premise in self.prems:
             nmatch = premise.num_to_names(match)
             premise.dispatch(nmatch, network)
 
 from sqlalchemy.sql import select
-from sqlalchemy.sql.expression import Select
 
 class NoMatches(Exception):
     pass
@@ -561,18 +1390,18 @@ class Premise(Base):
     def dispatch(self, match, network):
         prems = [p for p in self.rule.prems if p != self]
         try:
-            if prems:
-                matches = self.recurse_premises(match, prems, network)
-            else:
+            if not prems:
                 matches = [match]
+            elif network.join_plans:
+                matches = self.follow_plan(match, network)
+            else:
+                matches = self.recurse_premises(match, prems, network)
         except NoMatches:
             return
         for m in matches:
             self.rule.dispatch(m, network)
 
-    def recurse_premises(self, match, remaining_prems, network):
-        prem, pmatches = self.pick_prem(remaining_prems, match, network)
-        remaining_prems.remove(prem)
+    def extend_matches(self, match, prem, pmatches, network):
         matches = []
         for pm in pmatches:
             new_match = match.copy()
@@ -586,6 +1415,74 @@ class Premise(Base):
                 passes = True
             if passes:
                 matches.append(new_match)
+        return matches
+
+    def make_plan(self, network):
+        '''
+        Build the join plan for facts entering the rule through this premise:
+        the rest of the premises of the rule, greedily ordered
+        so that each one has as many bound vars as possible,
+        and, among those, as few matches as possible.
+        '''
+        self.plan = []
+        bound = {pvar.varname.name for pvar in self.pvars}
+        remaining = [p for p in self.rule.prems if p != self]
+        cards = {p.id: network.count_matches(p.node) for p in remaining}
+        n = 0
+        while remaining:
+            def cost(p):
+                nbound = len([v for v in p.pvars if v.varname.name in bound])
+                return (-nbound, cards[p.id], p.order)
+            remaining.sort(key=cost)
+            prem = remaining.pop(0)
+            nums = [v.num for v in prem.pvars if v.varname.name in bound]
+            self.plan.append(PlanStep(prem, n, nums, cards[prem.id]))
+            bound.update(v.varname.name for v in prem.pvars)
+            n += 1
+        network.plan_activations[self.id] = 0
+
+    def get_plan(self, network):
+        '''
+        The join plan for this premise,
+        rebuilt if it is missing or if, when checked,
+        the cardinalities it was based on have drifted.
+        '''
+        if not self.plan:
+            self.make_plan(network)
+        elif network.plan_check:
+            network.plan_activations[self.id] += 1
+            if network.plan_activations[self.id] >= network.plan_check:
+                network.plan_activations[self.id] = 0
+                for step in self.plan:
+                    if step.drifted(network):
+                        self.make_plan(network)
+                        break
+        return self.plan
+
+    def follow_plan(self, match, network):
+        matches = [match]
+        for step in self.get_plan(network):
+            prem = step.prem
+            new_matches = []
+            for m in matches:
+                pvar_map = step.get_pvar_map(m)
+                if network.beta is not None:
+                    ids = network.beta.filter(prem.node, pvar_map)
+                    pmatches = network.beta.load(ids) if ids else ()
+                else:
+                    pmatches = prem.filter_pmatches(m, network,
+                                                    pvar_map=pvar_map,
+                                                    count=False)
+                new_matches += self.extend_matches(m, prem, pmatches, network)
+            if not new_matches:
+                raise NoMatches
+            matches = new_matches
+        return matches
+
+    def recurse_premises(self, match, remaining_prems, network):
+        prem, pmatches = self.pick_prem(remaining_prems, match, network)
+        remaining_prems.remove(prem)
+        matches = self.extend_matches(match, prem, pmatches, network)
         if not remaining_prems:
             return matches
         else:
@@ -598,11 +1495,21 @@ class Premise(Base):
             return new_matches
 
     def pick_prem(self, prems, match, network):
+        if network.beta is not None:
+            return self.pick_prem_in_memory(prems, match, network)
         count, pmatches, picked = float('inf'), None, None
-        prems.sort(key=lambda p: p.node.matches.count())
+        prems.sort(key=lambda p: network.count_matches(p.node))
         for prem in prems:
-            pms = prem.filter_pmatches(match, network)
-            newcount = pms.count() if pms else 0
+            pvar_map = self.rule.get_pvar_map(match, prem)
+            pms = prem.filter_pmatches(match, network, pvar_map=pvar_map)
+            newcount = None
+            if network.stats is not None:
+                # the counters only order the premises;
+                # whether there are matches is asked to the db,
+                # so a counter at 0 still costs a count query
+                newcount = prem.estimate_pmatches(pvar_map, network) or None
+            if newcount is None:
+                newcount = pms.count() if pms else 0
             if newcount == 0:
                 raise NoMatches
             elif newcount == 1:
@@ -611,9 +1518,42 @@ class Premise(Base):
                 count, pmatches, picked = newcount, pms, prem
         return picked, pmatches
 
-    def filter_pmatches(self, match, network):
+    def pick_prem_in_memory(self, prems, match, network):
+        '''
+        The same as pick_prem, but joining in the beta memory.
+        '''
+        beta = network.beta
+        count, pmatches, picked = float('inf'), None, None
+        prems.sort(key=lambda p: beta.count(p.node))
+        for prem in prems:
+            pvar_map = self.rule.get_pvar_map(match, prem)
+            pms = beta.filter(prem.node, pvar_map)
+            newcount = len(pms)
+            if newcount == 0:
+                raise NoMatches
+            elif newcount == 1:
+                return prem, beta.load(pms)
+            if newcount < count:
+                count, pmatches, picked = newcount, pms, prem
+        return picked, beta.load(pmatches)
+
+    def estimate_pmatches(self, pvar_map, network):
+        '''
+        An upper bound for the number of matches of the premise node
+        with the values in pvar_map, taken from the statistics.
+        '''
+        network.index_pending()
+        stats = network.stats
+        n = stats.count_prem(self.node.id)
+        for var, val in pvar_map:
+            mtype = 1 if isinstance(val, Predicate) else 0
+            n = min(n, stats.count_pair(self.node.id, var, mtype, val.id))
+        return n
+
+    def filter_pmatches(self, match, network, pvar_map=None, count=True):
         pmatches = self.node.matches
-        pvar_map = self.rule.get_pvar_map(match, self)
+        if pvar_map is None:
+            pvar_map = self.rule.get_pvar_map(match, self)
         subqueries = []
         for var, val in pvar_map:
             apair = aliased(MPair)
@@ -624,16 +1564,26 @@ class Premise(Base):
                 cpair = aliased(TPair.__table__)
                 ccol = cpair.c.term_id
             subquery = select([apair.parent_id], from_obj=[apair, cpair], whereclause=(apair.var==var)&(ccol==val.id)&(apair.id==cpair.c.mid), distinct=True)
-            subqueries.append(subquery)
+            subqueries.append((subquery, var, val))
         if subqueries:
-            def count_subquery(q):
-                n = network.session.execute(aliased(q).count()).scalar()
+            def count_subquery(sq):
+                q, var, val = sq
+                if network.stats is not None:
+                    network.index_pending()
+                    mtype = 1 if isinstance(val, Predicate) else 0
+                    n = network.stats.count_pair(self.node.id, var, mtype, val.id)
+                    if n:
+                        return n
+                # no counter, or a counter at 0 that may be stale:
+                # count in the db, to stop early if there are no matches
+                n = network.session.execute(select([func.count()]).select_from(q.alias())).scalar()
                 if n == 0:
                     raise NoMatches
                 return n
-            subqueries.sort(key=count_subquery)
-            subquery = functools.reduce(Select.intersect, subqueries)
-            pmatches = pmatches.filter(PMatch.id.in_(subquery)).distinct(PMatch.id)
+            if count:
+                subqueries.sort(key=count_subquery)
+            for sq in subqueries:
+                pmatches = pmatches.filter(PMatch.id.in_(sq[0]))
         return pmatches
 
 
@@ -699,6 +1649,141 @@ class PPair(MPair):
     pindex = Index('pindex', 'mid', 'pred_id')
 
 
+class PremMemory(object):
+    '''
+    The matches of a premise node, indexed by the values of their vars.
+    '''
+
+    def __init__(self):
+        self.facts = {}  # pmatch id -> fact id
+        self.index = defaultdict(set)  # (var, mtype, value id) -> pmatch ids
+        self.keys = {}  # pmatch id -> its keys in the index
+
+    def add(self, pmatch_id, fact_id, pairs):
+        self.facts[pmatch_id] = fact_id
+        self.keys[pmatch_id] = tuple(pairs)
+        for key in pairs:
+            self.index[key].add(pmatch_id)
+
+    def remove(self, pmatch_id):
+        del self.facts[pmatch_id]
+        for key in self.keys.pop(pmatch_id):
+            ids = self.index[key]
+            ids.discard(pmatch_id)
+            if not ids:
+                del self.index[key]
+
+
+class BetaMemory(object):
+    '''
+    An in-process index of the matches (PMatch) of the premise nodes,
+    used to join premises with dictionary intersections
+    rather than with SQL.
+    The memory of each premise node is loaded from the db
+    the first time it is needed,
+    and then kept in sync as matches are added
+    and as facts are removed.
+    '''
+
+    def __init__(self, network):
+        self.network = network
+        self.memories = {}  # premnode id -> PremMemory
+        self.by_fact = defaultdict(list)  # fact id -> (premnode id, pmatch id)
+        event.listen(network.session, 'after_rollback', self.clear)
+
+    def clear(self, *args):
+        self.memories.clear()
+        self.by_fact.clear()
+
+    def get(self, pnode):
+        self.network.index_pending()
+        memory = self.memories.get(pnode.id)
+        if memory is None:
+            memory = self._load(pnode)
+        return memory
+
+    def _load(self, pnode):
+        session = self.network.session
+        session.flush()
+        memory = PremMemory()
+        pmatchs = PMatch.__table__
+        mpairs = MPair.__table__
+        tpairs = TPair.__table__
+        ppairs = PPair.__table__
+        from_obj = pmatchs.outerjoin(mpairs, mpairs.c.parent_id==pmatchs.c.id)
+        from_obj = from_obj.outerjoin(tpairs, tpairs.c.mid==mpairs.c.id)
+        from_obj = from_obj.outerjoin(ppairs, ppairs.c.mid==mpairs.c.id)
+        q = select([pmatchs.c.id, pmatchs.c.fact_id, mpairs.c.var,
+                    mpairs.c.mtype, tpairs.c.term_id, ppairs.c.pred_id],
+                   from_obj=[from_obj],
+                   whereclause=pmatchs.c.prem_id==pnode.id)
+        pmatches = defaultdict(list)
+        facts = {}
+        for pmid, fact_id, var, mtype, term_id, pred_id in session.execute(q):
+            facts[pmid] = fact_id
+            if var is not None:
+                vid = pred_id if mtype else term_id
+                pmatches[pmid].append((var, mtype, vid))
+        for pmid, fact_id in facts.items():
+            memory.add(pmid, fact_id, pmatches[pmid])
+            self.by_fact[fact_id].append((pnode.id, pmid))
+        self.memories[pnode.id] = memory
+        return memory
+
+    def add(self, pmatch):
+        '''
+        Index a new (flushed) match.
+        '''
+        memory = self.memories.get(pmatch.prem_id)
+        if memory is None:
+            return
+        pairs = [(p.var, 1 if isinstance(p, PPair) else 0, p.val.id)
+                 for p in pmatch.pairs]
+        memory.add(pmatch.id, pmatch.fact_id, pairs)
+        self.by_fact[pmatch.fact_id].append((pmatch.prem_id, pmatch.id))
+
+    def remove_fact(self, fact_id):
+        for pnode_id, pmid in self.by_fact.pop(fact_id, ()):
+            memory = self.memories.get(pnode_id)
+            if memory is not None:
+                memory.remove(pmid)
+
+    def forget(self, pnode_id):
+        self.memories.pop(pnode_id, None)
+
+    def count(self, pnode):
+        return len(self.get(pnode).facts)
+
+    def filter(self, pnode, pvar_map):
+        '''
+        Get the ids of the matches of pnode that have the values
+        given in pvar_map (a sequence of var number, value pairs).
+        '''
+        memory = self.get(pnode)
+        if not pvar_map:
+            return set(memory.facts)
+        sets = []
+        for var, val in pvar_map:
+            mtype = 1 if isinstance(val, Predicate) else 0
+            ids = memory.index.get((var, mtype, val.id))
+            if not ids:
+                return set()
+            sets.append(ids)
+        sets.sort(key=len)
+        return sets[0].intersection(*sets[1:])
+
+    def load(self, ids):
+        '''
+        Get the PMatch objects for the given ids, with their pairs.
+        '''
+        ids = list(ids)
+        pmatches = []
+        for n in range(0, len(ids), CHUNK):
+            q = self.network.session.query(PMatch).options(joinedload(PMatch.pairs))
+            pmatches.extend(q.filter(PMatch.id.in_(ids[n:n + CHUNK])))
+        return pmatches
+
+
 class PVarname(Base):
     """
     Mapping from varnames in rules (pvars belong in rules)
@@ -730,6 +1815,50 @@ class PVarname(Base):
         self.varname = varname
 
 
+class PlanStep(Base):
+    '''
+    A step in the join plan of a premise (the entry):
+    when a fact matches the entry, the matches of prem
+    are joined at position step, with the (comma separated)
+    var numbers in bound already bound by previous steps.
+    card is the number of matches of prem when the plan was made.
+    '''
+    __tablename__ = 'plansteps'
+
+    id = Column(Integer, Sequence('planstep_id_seq'), primary_key=True)
+    entry_id = Column(Integer, ForeignKey('premises.id'), index=True)
+    entry = relationship('Premise', backref=backref('plan', order_by='PlanStep.step',
+                                                    cascade='all,delete-orphan'),
+                         primaryjoin="Premise.id==PlanStep.entry_id")
+    prem_id = Column(Integer, ForeignKey('premises.id'), index=True)
+    prem = relationship('Premise',
+                         primaryjoin="Premise.id==PlanStep.prem_id")
+    step = Column(Integer)
+    bound = Column(String)
+    card = Column(Integer)
+
+    def __init__(self, prem, step, bound, card):
+        self.prem = prem
+        self.step = step
+        self.bound = ','.join(str(num) for num in bound)
+        self.card = card
+
+    def get_pvar_map(self, match):
+        if not self.bound:
+            return []
+        rule = self.prem.rule
+        pvar_map = []
+        for num in self.bound.split(','):
+            num = int(num)
+            pvar_map.append((num, match[rule.get_varname(self.prem, num)]))
+        return pvar_map
+
+    def drifted(self, network):
+        old = self.card
+        new = network.count_matches(self.prem.node)
+        return max(old, new) > network.plan_drift * (min(old, new) + 1)
+
+
 class Varname(Base):
     """
     a variable in a rule,
@@ -786,8 +1915,14 @@ class Rule(Base):
         for con in self.vconsecuences:
             cons.append(match[con.name])
 
+        batch = []
         for con in cons:
             factset = network.present
+            if batch and (isa(con, network.lexicon.exclusive_endure) or
+                          isa(con, network.lexicon.finish)):
+                # the facts to finish may be in the batch
+                self._add_batch(batch, network)
+                batch = []
             if isa(con, network.lexicon.exclusive_endure):
                 old_pred = Predicate(con.true, con.term_type)
                 old_pred.add_object('subj', con.get_object('subj'))
@@ -804,18 +1939,44 @@ class Rule(Base):
             #contradiction = factset.query(neg)
             #if contradiction:
             #    raise exceptions.Contradiction('we already have ' + str(neg))
-            if factset.query_facts(con, {}).count() == 0:
+            if factset.bulk:
+                batch.append(con)
+                continue
+            if factset.get_fact(con) is None:
                 if isa(con, network.lexicon.endure):
                     con.add_object('since_', network.lexicon.now_term)
                 fact = factset.add_fact(con)
                 if isa(con, network.lexicon.happen):
                     if network.pipe is not None:
                         network.pipe.send_bytes(str(con).encode('utf8'))
-                if network.root.child_path:
+                if network.get_root().child_path:
                     m = Match(con)
                     m.paths = network.get_paths(con)
                     m.fact = fact
-                    network.activations.append(m)
+                    network.agenda.push(m, self)
+        if batch:
+            self._add_batch(batch, network)
+
+    def _add_batch(self, cons, network):
+        '''
+        Add the new consecuences in cons with a single FactWriter,
+        and push their matches to the agenda.
+        '''
+        factset = network.present
+        cons = factset.filter_new(cons)
+        for con in cons:
+            if isa(con, network.lexicon.endure):
+                con.add_object('since_', network.lexicon.now_term)
+        facts = factset.add_facts(cons)
+        for con, fact in zip(cons, facts):
+            if isa(con, network.lexicon.happen):
+                if network.pipe is not None:
+                    network.pipe.send_bytes(str(con).encode('utf8'))
+            if network.get_root().child_path:
+                m = Match(con)
+                m.paths = network.get_paths(con)
+                m.fact = fact
+                network.agenda.push(m, self)
 
     def get_pvar_map(self, match, prem):
         pvar_map = []
@@ -0,0 +1,220 @@
+# Copyright (c) 2007-2012 by Enrique Pérez Arnaud <enriquepablo@gmail.com>
+#
+# This file is part of the terms project.
+# https://github.com/enriquepablo/terms
+#
+# The terms project is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The terms project is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any part of the terms project.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+from collections import OrderedDict
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import Column, ForeignKey, Integer
+from sqlalchemy import sql
+
+from terms.core.terms import Base, Term, Predicate, get_bases
+from terms.core.factset import CHUNK
+from terms.core.utils import Match
+
+
+class VerbVersion(Base):
+    '''
+    A counter for each verb, increased whenever a transaction
+    that adds or removes facts with the verb, or with any subverb,
+    is committed.
+    Cached answers are checked against these versions,
+    so that they are invalidated by writes from other processes.
+    '''
+    __tablename__ = 'verbversions'
+
+    verb_id = Column(Integer, ForeignKey('terms.id'), primary_key=True)
+    version = Column(Integer)
+
+
+def query_verbs(preds):
+    '''
+    The ids of the verbs whose facts (or the facts of whose subverbs)
+    can match the predicates in a question.
+    '''
+    ids = set()
+    for pred in preds:
+        verb = pred.term_type
+        if verb.var:
+            ids.update(b.id for b in verb.bases)
+        else:
+            ids.add(verb.id)
+    return frozenset(ids)
+
+
+def has_conditions(pred):
+    for label in pred.objects:
+        value = pred.get_object(label)
+        if isinstance(value, Predicate):
+            if has_conditions(value):
+                return True
+        elif getattr(value, 'set_condition', False):
+            return True
+    return False
+
+
+def touched_verbs(verb):
+    '''
+    The ids of the verbs whose cached answers are invalidated
+    by adding or removing a fact with verb.
+    '''
+    return {verb.id} | {b.id for b in get_bases(verb)}
+
+
+def read_versions(session, verb_ids):
+    vtable = VerbVersion.__table__
+    q = sql.select([vtable.c.verb_id, vtable.c.version])
+    q = q.where(vtable.c.verb_id.in_(list(verb_ids)))
+    versions = dict(session.execute(q).fetchall())
+    return tuple(versions.get(i, 0) for i in sorted(verb_ids))
+
+
+def bump_versions(session, verb_ids):
+    vtable = VerbVersion.__table__
+    verb_ids = list(verb_ids)
+    for n in range(0, len(verb_ids), CHUNK):
+        chunk = verb_ids[n:n + CHUNK]
+        q = sql.select([vtable.c.verb_id]).where(vtable.c.verb_id.in_(chunk))
+        old = {row[0] for row in session.execute(q)}
+        if old:
+            q = vtable.update().where(vtable.c.verb_id.in_(list(old)))
+            session.execute(q.values(version=vtable.c.version + 1))
+        new = [{'verb_id': i, 'version': 1} for i in chunk if i not in old]
+        if new:
+            session.execute(vtable.insert(), new)
+
+
+class QueryCache(object):
+    '''
+    An LRU cache of answers to questions,
+    shared by all the networks in a process.
+
+    Answers are keyed by the text of the predicates in the question,
+    and stored as the names and ids of the values in each match,
+    with the versions of the verbs in the question when they were computed.
+    '''
+
+    def __init__(self, size, max_rows):
+        self.size = size
+        self.max_rows = max_rows
+        self.entries = OrderedDict()  # key -> (verb ids, versions, rows)
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.entries.clear()
+
+    def invalidate(self, verb_ids):
+        for key, entry in tuple(self.entries.items()):
+            if entry[0] & verb_ids:
+                del self.entries[key]
+
+    def get(self, session, key, verb_ids):
+        '''
+        Return the cached matches for key, or None,
+        and the current versions of verb_ids.
+        '''
+        versions = read_versions(session, verb_ids)
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[1] == versions:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self._load(session, entry[2]), versions
+            del self.entries[key]
+        self.misses += 1
+        return None, versions
+
+    def put(self, key, verb_ids, versions, matches):
+        rows = []
+        for m in matches:
+            row = []
+            for name, value in m.items():
+                if value.id is None:
+                    return
+                kind = isinstance(value, Predicate) and 'p' or 't'
+                row.append((name, kind, value.id))
+            rows.append(tuple(row))
+        self.entries[key] = (verb_ids, versions, rows)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def _load(self, session, rows):
+        ids = {'t': set(), 'p': set()}
+        for row in rows:
+            for name, kind, i in row:
+                ids[kind].add(i)
+        values = {}
+        for kind, cls in (('t', Term), ('p', Predicate)):
+            kids = list(ids[kind])
+            for n in range(0, len(kids), CHUNK):
+                q = session.query(cls).filter(cls.id.in_(kids[n:n + CHUNK]))
+                for value in q:
+                    values[(kind, value.id)] = value
+        matches = []
+        for row in rows:
+            match = Match(None)
+            for name, kind, i in row:
+                match[name] = values[(kind, i)]
+            matches.append(match)
+        return matches
+
+    def cached(self, session, preds, matches):
+        '''
+        Iterate over the answer for preds,
+        taken from the cache if it is there and up to date,
+        or from matches (an iterator over a fresh answer) otherwise,
+        in which case it is cached once it has been consumed.
+        '''
+        if any(has_conditions(pred) for pred in preds):
+            yield from matches()
+            return
+        key = tuple(str(pred) for pred in preds)
+        verb_ids = query_verbs(preds)
+        answer, versions = self.get(session, key, verb_ids)
+        if answer is not None:
+            yield from answer
+            return
+        answer = []
+        for m in matches():
+            if answer is not None:
+                answer.append(m)
+                if len(answer) > self.max_rows:
+                    answer = None
+            yield m
+        if answer is not None:
+            self.put(key, verb_ids, versions, answer)
+
+
+_caches = WeakKeyDictionary()
+
+
+def get_query_cache(config, engine):
+    '''
+    Get the query cache for the db behind engine,
+    or None if it is not enabled in config.
+    '''
+    size = int(config['query_cache_size'])
+    if not size:
+        return None
+    if engine not in _caches:
+        max_rows = int(config['query_cache_max_rows'])
+        _caches[engine] = QueryCache(size, max_rows)
+    return _caches[engine]
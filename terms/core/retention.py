@@ -0,0 +1,126 @@
+# Copyright (c) 2007-2012 by Enrique Pérez Arnaud <enriquepablo@gmail.com>
+#
+# This file is part of the terms project.
+# https://github.com/enriquepablo/terms
+#
+# The terms project is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The terms project is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any part of the terms project.
+# If not, see <http://www.gnu.org/licenses/>.
+
+from collections import Counter
+
+from sqlalchemy import sql
+
+from terms.core.terms import term_ancestors
+from terms.core.factset import CHUNK
+
+
+def parse_verbs(value):
+    '''
+    Parse a comma separated list of verb:instants pairs.
+    '''
+    verbs = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            name, n = item.split(':')
+            verbs.append((name.strip(), int(n)))
+        except ValueError:
+            raise ValueError('Wrong past retention for a verb: ' + item)
+    return verbs
+
+
+def format_report(counts):
+    kinds = ('facts', 'predicates', 'objects', 'segments', 'matches', 'pairs')
+    return 'compacted the past: ' + ', '.join(
+            '%d %s' % (counts[kind], kind) for kind in kinds)
+
+
+class Retention(object):
+    '''
+    Delete the facts in the past that are older
+    than the retention period of their verbs:
+    past_retention instants,
+    or the number given for the verb (or for its nearest ancestor verb,
+    by depth in term_ancestors) in past_retention_verbs.
+    A retention of 0 keeps the facts forever.
+    '''
+
+    def __init__(self, network, config):
+        self.network = network
+        self.lexicon = network.lexicon
+        self.keep = int(config['past_retention'])
+        self.verbs = parse_verbs(config['past_retention_verbs'])
+
+    def policies(self):
+        '''
+        A list of (instants, verbs, exclude) tuples,
+        with the retention of the facts of the verbs in verbs
+        (a set of verb ids, or None for all verbs but those in exclude).
+        '''
+        lexicon = self.lexicon
+        keeps = {lexicon.get_term(name).id: n for name, n in self.verbs}
+        # the most specific verbs take precedence:
+        # each verb takes the retention of its nearest listed ancestor,
+        # or the longest one among ancestors at the same depth
+        by_verb, ranks = {}, {}
+        if keeps:
+            ta = term_ancestors
+            q = sql.select([ta.c.term_id, ta.c.ancestor_id, ta.c.depth])
+            q = q.where(ta.c.ancestor_id.in_(list(keeps)))
+            for term_id, ancestor_id, depth in self.network.session.execute(q):
+                keep = keeps[ancestor_id]
+                rank = (depth, -(keep or float('inf')))
+                if term_id not in ranks or rank < ranks[term_id]:
+                    ranks[term_id] = rank
+                    by_verb[term_id] = keep
+        policies = []
+        for keep in sorted(set(by_verb.values())):
+            if keep:
+                verbs = {v for v, n in by_verb.items() if n == keep}
+                policies.append((keep, verbs, None))
+        if self.keep:
+            policies.append((self.keep, None, set(by_verb)))
+        return policies
+
+    def expired(self, limit=CHUNK):
+        '''
+        Up to limit (fact id, pred id) rows of expired facts.
+        '''
+        now = int(self.network.now)
+        past = self.network.past
+        for keep, verbs, exclude in self.policies():
+            rows = past.fact_ids_before(now - keep, verbs=verbs,
+                                        exclude=exclude, limit=limit)
+            if rows:
+                return rows
+        return []
+
+    def compact(self, commit=None):
+        '''
+        Delete all expired facts, CHUNK at a time,
+        calling commit after each chunk,
+        so that other sessions are not blocked for long.
+        Return a Counter with the number of deleted rows of each kind.
+        '''
+        counts = Counter()
+        while True:
+            rows = self.expired()
+            if not rows:
+                break
+            counts.update(self.network.remove_facts(self.network.past, rows))
+            if commit is not None:
+                commit()
+        return counts
@@ -7,6 +7,8 @@ from sqlalchemy.orm import sessionmaker
 from terms.core.utils import get_config
 from terms.core.network import Network
 from terms.core.terms import Base
+from terms.core.lexicon import Lexicon
+from terms.core.wide import WideFacts
 
 
 def init_terms():
@@ -18,5 +20,8 @@ def init_terms():
     session = Session()
     Network.initialize(session)
     session.commit()
+    if int(config['wide_facts']):
+        WideFacts(Lexicon(session, config)).create_tables()
+        session.commit()
     session.close()
     sys.exit('Created knowledge store %s' % config['dbname'])
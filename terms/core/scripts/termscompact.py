@@ -0,0 +1,17 @@
+import sys
+
+from terms.core.utils import get_config
+from terms.core.sa import get_sasession
+from terms.core.compiler import Compiler
+from terms.core.retention import Retention, format_report
+
+
+def compact():
+    config = get_config()
+    session = get_sasession(config)()
+    compiler = Compiler(session, config)
+    retention = Retention(compiler.network, config)
+    counts = retention.compact(commit=session.commit)
+    session.commit()
+    session.close()
+    sys.exit(format_report(counts))
@@ -0,0 +1,122 @@
+import sys
+
+from sqlalchemy import create_engine, inspect, sql
+from sqlalchemy.orm import sessionmaker
+
+from terms.core.utils import get_config
+from terms.core.terms import Base
+from terms.core import network  # so that all mappers are configured
+from terms.core.factset import Fact, Segment, SegmentPath, FactInterval
+from terms.core.factset import fact_key, select_intervals, TIME_LABELS
+from terms.core.lexicon import Lexicon
+from terms.core.wide import WideFacts
+from terms.core.stats import Statistic, Statistics
+
+
+def add_column(session, table, column, coltype):
+    session.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, coltype))
+
+
+def migrate_fact_keys(session):
+    '''
+    Add the facts.key column, and the keys of present facts.
+    '''
+    add_column(session, 'facts', 'key', 'VARCHAR(40)')
+    ftable = Fact.__table__
+    q = session.query(Fact).filter(Fact.factset=='present')
+    for fact in q:
+        key = fact_key(fact.pred)
+        session.execute(ftable.update().where(ftable.c.id==fact.id).values(key=key))
+    for index in ftable.indexes:
+        if index.columns.contains_column(ftable.c.key):
+            index.create(session.connection())
+
+
+def migrate_paths(session):
+    '''
+    Replace the dotted path strings in segments
+    with references to the paths table.
+    '''
+    add_column(session, 'segments', 'path_id', 'INTEGER')
+    ptable = SegmentPath.__table__
+    paths = session.execute('SELECT DISTINCT path FROM segments')
+    rows = [{'path': row[0]} for row in paths if row[0] is not None]
+    if rows:
+        session.execute(ptable.insert(), rows)
+    session.execute('UPDATE segments SET path_id = '
+                    '(SELECT paths.id FROM paths WHERE paths.path = segments.path)')
+    for index in Segment.__table__.indexes:
+        names = [c.name for c in index.columns]
+        if 'path_id' in names:
+            index.create(session.connection())
+    session.execute('DROP INDEX ix_segments_path')
+    session.execute('ALTER TABLE segments DROP COLUMN path')
+
+
+def migrate_intervals(session, config):
+    '''
+    Fill the factintervals table from the segments of past facts.
+    '''
+    ptable = SegmentPath.__table__
+    path_ids = {}
+    for label in TIME_LABELS:
+        q = sql.select([ptable.c.id]).where(ptable.c.path=='%s._num' % label)
+        path_ids[label] = session.execute(q).scalar()
+    where = Fact.__table__.c.factset=='past'
+    q = select_intervals(path_ids, where, int(config['past_partition_size']))
+    names = ['fact_id', 'part'] + list(TIME_LABELS)
+    session.execute(FactInterval.__table__.insert().from_select(names, q))
+
+
+def missing_stats(session):
+    '''
+    Whether the store has matches but no counters,
+    as when it has been run with statistics off.
+    '''
+    if session.query(Statistic).first() is not None:
+        return False
+    return session.query(network.PMatch).first() is not None
+
+
+def migrate():
+    '''
+    Bring a knowledge store created by an older version up to date.
+    New tables are created,
+    and new columns are added and filled.
+    If statistics are on and have never been kept, they are computed.
+    If wide_facts is on, the verbs that have no wide table get one.
+    '''
+    config = get_config()
+    address = '%s/%s' % (config['dbms'], config['dbname'])
+    engine = create_engine(address)
+    new_intervals = not engine.dialect.has_table(engine, 'factintervals')
+    new_ancestors = not engine.dialect.has_table(engine, 'term_ancestors')
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    session = Session()
+    inspector = inspect(engine)
+    done = []
+    if 'key' not in [c['name'] for c in inspector.get_columns('facts')]:
+        migrate_fact_keys(session)
+        done.append('fact keys')
+    if 'path_id' not in [c['name'] for c in inspector.get_columns('segments')]:
+        migrate_paths(session)
+        done.append('segment paths')
+    if new_intervals:
+        migrate_intervals(session, config)
+        done.append('past intervals')
+    if new_ancestors:
+        Lexicon.rebuild_ancestors(session)
+        done.append('term ancestors')
+    if int(config['statistics']) and missing_stats(session):
+        Statistics.rebuild(session)
+        done.append('statistics')
+    if int(config['wide_facts']):
+        wide = WideFacts(Lexicon(session, config))
+        if wide.create_tables():
+            done.append('wide fact tables')
+    session.commit()
+    session.close()
+    if done:
+        sys.exit('Migrated %s in %s' % (', '.join(done), config['dbname']))
+    sys.exit('%s is up to date' % config['dbname'])
@@ -0,0 +1,20 @@
+import sys
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from terms.core.utils import get_config
+from terms.core.stats import Statistic, Statistics
+
+
+def rebuild_stats():
+    config = get_config()
+    address = '%s/%s' % (config['dbms'], config['dbname'])
+    engine = create_engine(address)
+    Statistic.__table__.create(engine, checkfirst=True)
+    Session = sessionmaker(bind=engine)
+    session = Session()
+    n = Statistics.rebuild(session)
+    session.commit()
+    session.close()
+    sys.exit('Rebuilt %d counters in %s' % (n, config['dbname']))
@@ -0,0 +1,513 @@
+# Copyright (c) 2007-2012 by Enrique Pérez Arnaud <enriquepablo@gmail.com>
+#
+# This file is part of the terms project.
+# https://github.com/enriquepablo/terms
+#
+# The terms project is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The terms project is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any part of the terms project.
+# If not, see <http://www.gnu.org/licenses/>.
+
+import operator
+from collections import OrderedDict, defaultdict
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import Column, Integer, String, event
+from sqlalchemy import sql
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
+
+from terms.core.terms import Base, Predicate, isa
+from terms.core.factset import FactSet, FactWriter, Fact, NumberSegment
+from terms.core.factset import fact_key
+from terms.core.utils import Match
+
+
+# python counterparts of NumberSegment's sql operators
+binopers = dict(NumberSegment.binopers)
+binopers.update({
+    '|': lambda a, b: a or b,
+    '&': lambda a, b: a and b,
+})
+unopers = {
+    '~': operator.not_,
+    '-': operator.neg,
+}
+
+
+class FactRecord(object):
+    '''
+    The in-memory copy of a fact:
+    its id, the id of its predicate, its key,
+    and the value at each of its paths
+    (a boolean for _neg paths, an int for _num paths,
+    and a tuple with the ids of the term and of its type
+    for _term and _verb paths).
+    '''
+    __slots__ = ('id', 'pred_id', 'key', 'values')
+
+    def __init__(self, id, pred_id, key, values):
+        self.id = id
+        self.pred_id = pred_id
+        self.key = key
+        self.values = values
+
+
+class FactSetVersion(Base):
+    '''
+    A counter for each factset kept in memory,
+    increased by every transaction that adds or removes its facts.
+    The stores of all processes are checked against it.
+    '''
+    __tablename__ = 'factsetversions'
+
+    name = Column(String(16), primary_key=True)
+    version = Column(Integer, default=0)
+
+
+def read_factset_version(session, name):
+    vtable = FactSetVersion.__table__
+    q = sql.select([vtable.c.version]).where(vtable.c.name==name)
+    return session.execute(q).scalar() or 0
+
+
+def bump_factset_version(session, name):
+    '''
+    Increase the version of the factset name,
+    locking its row until the end of the transaction,
+    and return the new version.
+    '''
+    vtable = FactSetVersion.__table__
+    q = vtable.update().where(vtable.c.name==name)
+    if not session.execute(q.values(version=vtable.c.version + 1)).rowcount:
+        session.execute(vtable.insert(), [{'name': name, 'version': 1}])
+    return read_factset_version(session, name)
+
+
+class SegmentStore(object):
+    '''
+    The records of the facts in a factset,
+    indexed by fact id, by (path, value), and by fact key.
+    The store shared by the sessions of a process
+    has the committed facts as of version.
+    '''
+
+    def __init__(self):
+        self.records = OrderedDict()
+        self.index = defaultdict(set)
+        self.keys = {}
+        self.version = None
+
+    def add(self, record):
+        self.records[record.id] = record
+        for path, value in record.values.items():
+            self.index[(path, value_key(value))].add(record.id)
+        if record.key is not None:
+            self.keys[record.key] = record.id
+
+    def remove(self, record):
+        del self.records[record.id]
+        for path, value in record.values.items():
+            k = (path, value_key(value))
+            ids = self.index[k]
+            ids.discard(record.id)
+            if not ids:
+                del self.index[k]
+        if record.key is not None:
+            del self.keys[record.key]
+
+
+def value_key(value):
+    if isinstance(value, tuple):
+        return value[0]
+    return value
+
+
+_stores = WeakKeyDictionary()
+
+
+def get_store(engine, name):
+    '''
+    Get the SegmentStore for the factset name in the db of engine,
+    shared by all the sessions of the process.
+    '''
+    stores = _stores.setdefault(engine, {})
+    try:
+        return stores[name]
+    except KeyError:
+        store = stores[name] = SegmentStore()
+        return store
+
+
+class FactList(list):
+    '''
+    The facts that match a predicate,
+    with the part of the interface of sqlalchemy's Query
+    that is used on the result of query_facts.
+    '''
+
+    def first(self):
+        return self and self[0] or None
+
+    def one(self):
+        if not self:
+            raise NoResultFound('No row was found for one()')
+        if len(self) > 1:
+            raise MultipleResultsFound('Multiple rows were found for one()')
+        return self[0]
+
+    def all(self):
+        return list(self)
+
+    def count(self):
+        return len(self)
+
+
+class SegmentIndexFactSet(FactSet):
+    '''
+    A factset whose segments are kept in memory instead of in the db,
+    indexed by fact id and by (path, value),
+    and queried in python.
+    The facts and their predicates are still stored in the db,
+    since the matches in the network refer to them.
+
+    The committed facts are in a store shared by the sessions
+    of the process, that is reloaded from the db whenever
+    a transaction finds that the version of the factset in the db
+    is not that of the store, because another process has changed it.
+    The changes made in a transaction are kept apart,
+    in the facts added and the ids removed,
+    and only go into the shared store when the transaction is committed.
+    '''
+
+    sql = False
+
+    def __init__(self, name, lexicon, config, unique=False,
+                 touch=None, wide=None, intervals=False):
+        # wide tables and intervals are indexes in the db;
+        # the records in memory are already indexed by value
+        super(SegmentIndexFactSet, self).__init__(name, lexicon, config,
+                                            unique=unique, touch=touch)
+        self.store = get_store(self.session.bind, name)
+        self.facts = {}  # the Fact objects in this session, by id
+        self._reset()
+        event.listen(self.session, 'after_commit', self._commit)
+        event.listen(self.session, 'after_transaction_end', self._end)
+
+    def _reset(self):
+        self.added = SegmentStore()
+        self.removed = set()
+        self.checked = False  # the store is up to date for this transaction
+        self.version = None  # the version written by this transaction
+
+    def _check(self):
+        if self.checked:
+            return
+        version = read_factset_version(self.session, self.name)
+        if self.store.version != version:
+            self._load(version)
+        self.checked = True
+
+    def _load(self, version):
+        store = self.store
+        store.__init__()
+        q = self.session.query(Fact).filter(Fact.factset==self.name)
+        for fact in q.options(joinedload(Fact.pred)):
+            self.facts[fact.id] = fact
+            store.add(self._make_record(fact, fact.pred))
+        store.version = version
+
+    def _write(self):
+        self._check()
+        if self.version is None:
+            self.version = bump_factset_version(self.session, self.name)
+
+    def _commit(self, session):
+        store = self.store
+        if self.version is not None:
+            if store.version == self.version - 1:
+                for fact_id in self.removed:
+                    store.remove(store.records[fact_id])
+                for record in self.added.records.values():
+                    store.add(record)
+                store.version = self.version
+            else:
+                store.version = None  # reloaded by the next transaction
+        self._reset()
+
+    def _end(self, session, transaction):
+        if transaction._parent is None:  # not a subtransaction
+            for fact_id in self.added.records:
+                self.facts.pop(fact_id, None)
+            self._reset()
+
+    def _get_record(self, fact_id):
+        record = self.added.records.get(fact_id)
+        if record is None and fact_id not in self.removed:
+            record = self.store.records.get(fact_id)
+        return record
+
+    def _add(self, record):
+        self.added.add(record)
+
+    def _remove(self, record):
+        if record.id in self.added.records:
+            self.added.remove(record)
+        else:
+            self.removed.add(record.id)
+
+    def _records(self):
+        for record in self.store.records.values():
+            if record.id not in self.removed:
+                yield record
+        yield from self.added.records.values()
+
+    def _indexed(self, key):
+        ids = self.store.index.get(key, set()) - self.removed
+        return ids | self.added.index.get(key, set())
+
+    def _get_fact(self, record):
+        try:
+            return self.facts[record.id]
+        except KeyError:
+            fact = self.session.query(Fact).get(record.id)
+            self.facts[record.id] = fact
+            return fact
+
+    def _value(self, path, value):
+        ntype = path[-1]
+        if ntype == '_num':
+            return int(value.name)
+        elif ntype in ('_term', '_verb'):
+            return (value.id, value.term_type.id)
+        return value
+
+    def _make_record(self, fact, pred):
+        values = {}
+        for path in self.get_paths(pred):
+            cls = self._get_nclass(path)
+            value = cls.resolve(pred, path, self)
+            values[path] = self._value(path, value)
+        key = self.unique and fact_key(pred) or None
+        return FactRecord(fact.id, fact.pred_id, key, values)
+
+    def _add_record(self, fact, pred):
+        record = self._make_record(fact, pred)
+        self.facts[fact.id] = fact
+        self._add(record)
+        if self.touch is not None:
+            self.touch(pred.term_type)
+
+    def add_fact(self, pred):
+        if self.bulk:
+            return self.add_facts([pred])[0]
+        self._write()
+        print(pred)
+        fact = Fact(pred, self.name)
+        if self.unique:
+            fact.key = fact_key(pred)
+        self.session.add(fact)
+        self.session.flush()
+        self._add_record(fact, pred)
+        return fact
+
+    def add_facts(self, preds):
+        self._write()
+        writer = FactWriter(self, segments=False)
+        for pred in preds:
+            print(pred)
+            writer.add(pred)
+        ids = writer.write()
+        facts = self._load_facts(ids)
+        for fact, pred in zip(facts, preds):
+            self._add_record(fact, pred)
+        return facts
+
+    def forget_facts(self, fact_ids):
+        self._write()
+        for fact_id in fact_ids:
+            record = self._get_record(fact_id)
+            if record is not None:
+                self._remove(record)
+                self.facts.pop(record.id, None)
+
+    def fact_ids(self, pred, verbs=None):
+        rows = []
+        for record, names in self._match(pred):
+            if verbs is None or record.values[('_verb',)][0] in verbs:
+                rows.append((record.id, record.pred_id))
+        return rows
+
+    def fact_ids_before(self, instant, verbs=None, exclude=None, limit=None):
+        self._check()
+        rows = []
+        for record in self._records():
+            at_ = record.values.get(('at_', '_num'))
+            if at_ is None or at_ >= instant:
+                continue
+            verb = record.values[('_verb',)][0]
+            if verbs is not None and verb not in verbs:
+                continue
+            if exclude and verb in exclude:
+                continue
+            rows.append((record.id, record.pred_id))
+            if limit is not None and len(rows) == limit:
+                break
+        return rows
+
+    def _move_segments(self, rows, dest, path, value):
+        self._write()
+        dest._write()
+        for fact_id, pred_id in rows:
+            old = self._get_record(fact_id)
+            self._remove(old)
+            self.facts.pop(fact_id, None)
+            values = dict(old.values)
+            values[path] = value
+            dest._add(FactRecord(fact_id, pred_id, None, values))
+
+    def add_object_to_fact(self, fact, value, path):
+        self._write()
+        old = self._get_record(fact.id)
+        self._remove(old)
+        values = dict(old.values)
+        values[path] = self._value(path, value)
+        self._add(FactRecord(old.id, old.pred_id, old.key, values))
+        fact.pred.add_object(path[-2], value)
+
+    def filter_new(self, preds):
+        new, seen = [], set()
+        for pred in preds:
+            key = self.unique and fact_key(pred) or str(pred)
+            if key not in seen:
+                seen.add(key)
+                if self.get_fact(pred) is None:
+                    new.append(pred)
+        return new
+
+    def get_fact(self, pred):
+        if self.unique:
+            self._check()
+            key = fact_key(pred)
+            fid = self.added.keys.get(key)
+            if fid is None:
+                fid = self.store.keys.get(key)
+                if fid in self.removed:
+                    fid = None
+            if fid is None:
+                return None
+            return self._get_fact(self._get_record(fid))
+        for record, names in self._match(pred):
+            return self._get_fact(record)
+        return None
+
+    def query_facts(self, pred, taken_vars, with_factset=True,
+                    qfacts=None, fact=None):
+        '''
+        The facts that match pred, in a FactList.
+        They cannot be joined with other queries,
+        so qfacts and fact are not supported.
+        '''
+        if qfacts is not None:
+            raise ValueError('Facts in memory cannot be joined in sql')
+        facts = FactList()
+        for record, names in self._match(pred):
+            facts.append(self._get_fact(record))
+            taken_vars.update((name, (path, None)) for name, path in names.items())
+        return facts
+
+    def iter_query(self, pred):
+        for record, names in self._match(pred):
+            fact = self._get_fact(record)
+            match = Match(fact.pred, query=pred)
+            match.fact = fact
+            for name, path in names.items():
+                match[name] = self.resolve_var(fact, name, path)
+            yield match
+
+    def _match(self, pred):
+        '''
+        Iterate over the records that match pred,
+        each with a dict of the names of the vars in pred
+        to the paths where they are bound.
+        '''
+        self._check()
+        consts, vars = [], []
+        for path in self.get_paths(pred):
+            cls = self._get_nclass(path)
+            value = cls.resolve(pred, path, self)
+            if value is None:
+                continue
+            if getattr(value, 'var', False):
+                vars.append((path, value, self._allowed(path, value)))
+            else:
+                consts.append((path, value_key(self._value(path, value))))
+        vars.sort(key=lambda x: 1 if getattr(x[1], 'set_condition', False) else 0)
+        if consts:
+            sets = sorted((self._indexed(c) for c in consts), key=len)
+            ids = sets[0].intersection(*sets[1:])
+            records = [self._get_record(i) for i in sorted(ids)]
+        else:
+            records = list(self._records())
+        for record in records:
+            names = {}
+            bindings = {}
+            for path, var, allowed in vars:
+                try:
+                    value = record.values[path]
+                except KeyError:
+                    break
+                if var.name in bindings:
+                    if bindings[var.name] != value_key(value):
+                        break
+                    continue
+                if allowed is not None and not allowed(value):
+                    break
+                bindings[var.name] = value_key(value)
+                names[var.name] = path
+                condition = getattr(var, 'set_condition', False)
+                if condition and not self._eval(condition, bindings):
+                    break
+            else:
+                yield record, names
+
+    def _allowed(self, path, var):
+        '''
+        Build a test for the values that var can take at path,
+        or return None if there is no restriction.
+        '''
+        ntype = path[-1]
+        if ntype == '_term':
+            if var.bases:
+                ids = {b.id for b in self.lexicon.get_subterms(var.bases[0])}
+                return lambda value: value[0] in ids
+            ids = {b.id for b in self.lexicon.get_subterms(var.term_type)}
+            return lambda value: value[1] in ids
+        elif ntype == '_verb':
+            if isa(var, self.lexicon.verb):
+                sbases = self.lexicon.get_subterms(var.bases[0])
+            else:
+                sbases = self.lexicon.get_subterms(var.term_type)
+            ids = {b.id for b in sbases}
+            return lambda value: value[0] in ids
+        return None
+
+    def _eval(self, expr, bindings):
+        if expr.type == 's-vnum':
+            if expr.var:
+                return bindings[expr.val]
+            return int(expr.val)
+        arg1 = self._eval(expr.arg1, bindings)
+        if expr.arg2 is not None:
+            arg2 = self._eval(expr.arg2, bindings)
+            return binopers[expr.oper](arg1, arg2)
+        return unopers[expr.oper](arg1)
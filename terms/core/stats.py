@@ -0,0 +1,191 @@
+# Copyright (c) 2007-2012 by Enrique Pérez Arnaud <enriquepablo@gmail.com>
+#
+# This file is part of the terms project.
+# https://github.com/enriquepablo/terms
+#
+# The terms project is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The terms project is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any part of the terms project.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+from collections import Counter
+
+from sqlalchemy import Column, Sequence, Index, event
+from sqlalchemy import Integer, String
+from sqlalchemy import sql
+
+from terms.core.terms import Base
+
+
+class Statistic(Base):
+    '''
+    A counter.
+    kind is one of:
+     * 'prem', with key '<premnode id>',
+       for the number of matches of a premise node;
+     * 'pair', with key '<premnode id>:<var>:<mtype>:<value id>',
+       for the number of matches of a premise node
+       with a given value for one of its variables.
+    '''
+    __tablename__ = 'statistics'
+
+    id = Column(Integer, Sequence('statistic_id_seq'), primary_key=True)
+    kind = Column(String(4))
+    key = Column(String)
+    n = Column(Integer)
+
+Index('statistic_kind_key', Statistic.kind, Statistic.key, unique=True)
+
+
+def prem_key(pnode_id):
+    return str(pnode_id)
+
+
+def pair_key(pnode_id, var, mtype, value_id):
+    return '%s:%s:%s:%s' % (pnode_id, var, mtype, value_id)
+
+
+class Statistics(object):
+    '''
+    Cardinality statistics for the planner,
+    kept in the statistics table.
+    Changes to the counters are accumulated in memory
+    and written when the session is committed;
+    counters that have been read are cached.
+    '''
+
+    def __init__(self, session):
+        self.session = session
+        self.counts = {}  # (kind, key) -> n
+        self.deltas = Counter()  # (kind, key) -> change not yet written
+        event.listen(session, 'before_commit', self.write)
+        event.listen(session, 'after_rollback', self.clear)
+
+    def clear(self, *args):
+        self.counts.clear()
+        self.deltas.clear()
+
+    def get(self, kind, key):
+        k = (kind, key)
+        if k not in self.counts:
+            table = Statistic.__table__
+            q = sql.select([table.c.n]).where((table.c.kind==kind) &
+                                              (table.c.key==key))
+            n = self.session.execute(q).scalar() or 0
+            self.counts[k] = n + self.deltas[k]
+        return self.counts[k]
+
+    def incr(self, kind, key, n=1):
+        k = (kind, key)
+        self.deltas[k] += n
+        if k in self.counts:
+            self.counts[k] += n
+
+    def write(self, *args):
+        table = Statistic.__table__
+        for (kind, key), n in self.deltas.items():
+            if n == 0:
+                continue
+            where = (table.c.kind==kind) & (table.c.key==key)
+            q = table.update().where(where).values(n=table.c.n + n)
+            if self.session.execute(q).rowcount == 0:
+                self.session.execute(table.insert().values(kind=kind,
+                                                           key=key, n=n))
+        self.deltas.clear()
+
+    def count_prem(self, pnode_id):
+        return self.get('prem', prem_key(pnode_id))
+
+    def count_pair(self, pnode_id, var, mtype, value_id):
+        return self.get('pair', pair_key(pnode_id, var, mtype, value_id))
+
+    def add_pmatch(self, pnode_id, pairs, n=1):
+        '''
+        pairs is a sequence of (var, mtype, value id) tuples.
+        '''
+        self.incr('prem', prem_key(pnode_id), n)
+        for var, mtype, value_id in pairs:
+            self.incr('pair', pair_key(pnode_id, var, mtype, value_id), n)
+
+    def remove_pmatches(self, fact_ids):
+        '''
+        Discount the matches of facts that are about to be deleted.
+        '''
+        from terms.core.factset import CHUNK
+        from terms.core.network import PMatch, MPair, TPair, PPair
+        pmatchs = PMatch.__table__
+        mpairs = MPair.__table__
+        tpairs = TPair.__table__
+        ppairs = PPair.__table__
+        from_obj = pmatchs.outerjoin(mpairs, mpairs.c.parent_id==pmatchs.c.id)
+        from_obj = from_obj.outerjoin(tpairs, tpairs.c.mid==mpairs.c.id)
+        from_obj = from_obj.outerjoin(ppairs, ppairs.c.mid==mpairs.c.id)
+        pmatches = {}
+        for n in range(0, len(fact_ids), CHUNK):
+            chunk = fact_ids[n:n + CHUNK]
+            q = sql.select([pmatchs.c.id, pmatchs.c.prem_id, mpairs.c.var,
+                            mpairs.c.mtype, tpairs.c.term_id, ppairs.c.pred_id],
+                           from_obj=[from_obj],
+                           whereclause=pmatchs.c.fact_id.in_(chunk))
+            for pmid, pnode_id, var, mtype, term_id, pred_id in self.session.execute(q):
+                pnode_id, pairs = pmatches.setdefault(pmid, (pnode_id, []))
+                if var is not None:
+                    pairs.append((var, mtype, pred_id if mtype else term_id))
+        for pnode_id, pairs in pmatches.values():
+            self.add_pmatch(pnode_id, pairs, -1)
+
+    def forget_prem(self, pnode_id):
+        '''
+        Remove the counters of a premise node that is about to be deleted.
+        '''
+        table = Statistic.__table__
+        pkey = prem_key(pnode_id)
+        where = (((table.c.kind=='prem') & (table.c.key==pkey)) |
+                 ((table.c.kind=='pair') & table.c.key.startswith(pkey + ':')))
+        self.session.execute(table.delete().where(where))
+        for k in tuple(self.counts):
+            if k[1].split(':')[0] == pkey:
+                del self.counts[k]
+        for k in tuple(self.deltas):
+            if k[1].split(':')[0] == pkey:
+                del self.deltas[k]
+
+    @classmethod
+    def rebuild(cls, session):
+        '''
+        Recompute all counters from the facts and matches in the db.
+        '''
+        from terms.core.network import PMatch, MPair, TPair, PPair
+        table = Statistic.__table__
+        session.execute(table.delete())
+        rows = []
+        pmatchs = PMatch.__table__
+        q = sql.select([pmatchs.c.prem_id, sql.func.count(pmatchs.c.id)])
+        q = q.group_by(pmatchs.c.prem_id)
+        for pnode_id, n in session.execute(q):
+            rows.append({'kind': 'prem', 'key': prem_key(pnode_id), 'n': n})
+        mpairs = MPair.__table__
+        for ptable, col in ((TPair.__table__, 'term_id'),
+                            (PPair.__table__, 'pred_id')):
+            value_id = ptable.c[col]
+            from_obj = pmatchs.join(mpairs, mpairs.c.parent_id==pmatchs.c.id)
+            from_obj = from_obj.join(ptable, ptable.c.mid==mpairs.c.id)
+            cols = [pmatchs.c.prem_id, mpairs.c.var, mpairs.c.mtype, value_id]
+            q = sql.select(cols + [sql.func.count(mpairs.c.id)],
+                           from_obj=[from_obj]).group_by(*cols)
+            for pnode_id, var, mtype, vid, n in session.execute(q):
+                key = pair_key(pnode_id, var, mtype, vid)
+                rows.append({'kind': 'pair', 'key': key, 'n': n})
+        if rows:
+            session.execute(table.insert(), rows)
+        return len(rows)
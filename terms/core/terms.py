@@ -39,6 +39,18 @@ term_to_base = Table('term_to_base', Base.metadata,
     Column('base_id', Integer, ForeignKey('terms.id'))
 )
 
+# closure of term_to_base: a row for each term and each of its ancestors,
+# including the term itself at depth 0.
+# Var terms are not in it.
+term_ancestors = Table('term_ancestors', Base.metadata,
+    Column('term_id', Integer, ForeignKey('terms.id'), primary_key=True),
+    Column('ancestor_id', Integer, ForeignKey('terms.id'), primary_key=True),
+    Column('depth', Integer)
+)
+
+Index('ix_term_ancestors_ancestor', term_ancestors.c.ancestor_id,
+      term_ancestors.c.term_id)
+
 term_to_objtype = Table('term_to_objtype', Base.metadata,
     Column('term_id', Integer, ForeignKey('terms.id')),
     Column('objtype_id', Integer, ForeignKey('objecttypes.id'))
@@ -85,6 +97,7 @@ class Term(Base):
         self.name = name
         self.var = var
         self._sup_cache = None
+        self._sup_mask = None
         self._sub_cache = None
         if not _bootstrap:
             self.term_type = ttype or bases[0].term_type
@@ -113,24 +126,6 @@ class Term(Base):
         #  immutable
         return self
 
-    def purge_cache(self, lexicon):
-        for sub in lexicon.get_subterms(self):
-            sub.purge_sup()
-        for sup in get_bases(self):
-            sup.purge_sub(lexicon)
-
-    def purge_sup(self):
-        for sup in get_bases(self):
-            sup.purge_sup()
-        self._sup_cache = None
-
-    def purge_sub(self, lexicon):
-        for sub in lexicon.get_subterms(self):
-            if sub is self:
-                continue
-            sub.purge_sub(lexicon)
-        self._sub_cache = None
-
 
 class ObjectType(Base):
     ''' '''
@@ -230,11 +225,13 @@ class Predicate(Base):
     def get_vars(self, vars=None):
         if vars is None:
             vars = []
-        for o in self.objects:
-            if o.value.var:
-                vars.append(o.value)
-            elif isinstance(o.value, Predicate):
+        if self.term_type.var:
+            vars.append(self.term_type)
+        for o in self.objects.values():
+            if isinstance(o.value, Predicate):
                 o.value.get_vars(vars)
+            elif o.value.var:
+                vars.append(o.value)
         return vars
 
 
@@ -293,51 +290,83 @@ def isa(t1, t2):
 
 
 def are(t1, t2):
+    '''
+    Whether t1 is t2 or has it among its ancestors,
+    tested on the bitmask of the ancestors of t1.
+    '''
     if t1 == t2:
         return True
-    try:
-        equals = get_equals(t1, search=t2)
-        for eq in equals:
-            get_bases(eq, search=t2)
-    except SearchFound:
-        return True
-    return False
+    bit = get_bit(t2)
+    mask = get_mask(t1)
+    if bit is None or mask is None:
+        return t2 in get_bases(t1)
+    return bool(mask >> bit & 1)
 
 def eq(t1, t2):
-    if t1 == t2:
-        return True
+    return t1 == t2 or t2 in get_equals(t1)
+
+
+# dense bit numbers for the terms that are ancestors of other terms,
+# by term id
+_bits = {}
+
+def get_bit(term):
+    '''
+    The bit that stands for term in the masks of its descendants,
+    or None if the term is not yet in the db.
+    '''
+    bit = getattr(term, '_bit', None)
+    if bit is not None:
+        return bit
+    term_id = getattr(term, 'id', None)
+    if term_id is None:
+        return None
     try:
-        get_equals(t1, search=t2)
-    except SearchFound:
-        return True
-    return False
+        bit = _bits[term_id]
+    except KeyError:
+        bit = _bits[term_id] = len(_bits)
+    term._bit = bit
+    return bit
 
-def get_bases(term, search=None):
+def get_mask(term):
+    '''
+    The bitmask of the ancestors of term,
+    built from the masks of its bases,
+    or None if some ancestor is not yet in the db.
+    '''
+    mask = getattr(term, '_sup_mask', None)
+    if mask is not None:
+        return mask
+    mask = 0
+    for base in getattr(term, 'bases', None) or ():
+        bit = get_bit(base)
+        bmask = get_mask(base)
+        if bit is None or bmask is None:
+            return None
+        mask |= bmask | (1 << bit)
+    term._sup_mask = mask
+    return mask
+
+def get_bases(term):
     cache = getattr(term, '_sup_cache', None)
     if cache is not None:
-        if search and search in cache:
-            raise SearchFound(search)
         return cache
-    bases = _get_desc(term, 'bases', search=search)
+    bases = _get_desc(term, 'bases')
     term._sup_cache = bases
     return bases
 
-def get_equals(term, search=None):
-    return (term,) + _get_desc(term, 'equals', search=search)
-
-class SearchFound(Exception): pass
+def get_equals(term):
+    return (term,) + _get_desc(term, 'equals')
 
-def _get_desc(term, desc, search=None, bset=None):
+def _get_desc(term, desc, bset=None):
     if not bset:
         bset = set()
     bases = getattr(term, desc, None)
     if bases is None:
         return ()
     for base in bases:
-        if search and search == base:
-            raise SearchFound(base)
         bset.add(base)
-        _get_desc(base, desc, search=search, bset=bset)
+        _get_desc(base, desc, bset=bset)
         if desc != 'equals':
             for eq in base.equals:
                 bset.add(eq)
@@ -21,6 +21,7 @@
 import os
 import os.path
 import sys
+from collections import defaultdict
 from configparser import ConfigParser
 from optparse import OptionParser
 
@@ -70,30 +71,44 @@ class Match(dict):
 
 
 def merge_submatches(submatches):
-    final = []
-    while submatches:
-        final = submatches.pop()
-        if not final:
-            return final
-        elif not final[0]:
-            continue
-        break
-    while submatches:
-        sm = submatches.pop()
-        if not sm:
-            return sm
-        elif not sm[0]:
-            continue
-        new = []
-        for n in sm:
-            for m in final:
-                nm = m.merge(n)
-                if nm:
-                    new.append(nm)
-        final = new
+    '''
+    Join lists of matches on the variables they share.
+    All the matches in each list must bind the same variables.
+    Each list is hashed on the variables it shares
+    with the lists merged before it,
+    and the merged matches are produced lazily, one by one.
+    '''
+    if not all(submatches):
+        return iter(())
+    with_vars = [sm for sm in submatches if sm[0]]
+    if not with_vars:
+        return iter(submatches[0] if submatches else ())
+    final = iter(with_vars[-1])
+    names = set(with_vars[-1][0])
+    for sm in reversed(with_vars[:-1]):
+        shared = tuple(names.intersection(sm[0]))
+        index = defaultdict(list)
+        for m in sm:
+            index[tuple(m[k] for k in shared)].append(m)
+        final = _probe(final, index, shared)
+        names.update(sm[0])
     return final
 
 
+def _probe(matches, index, shared):
+    for m in matches:
+        for n in index.get(tuple(m[k] for k in shared), ()):
+            yield m.merge(n)
+
+
+def match_order(match):
+    '''
+    A sort key for matches, by the ids of the values of their vars.
+    '''
+    return [(name, getattr(value, 'id', None) or 0)
+            for name, value in sorted(match.items())]
+
+
 def get_config(cmd_line=True):
     config = ConfigParser()
     d = os.path.dirname(sys.modules['terms.core'].__file__)
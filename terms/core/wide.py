@@ -0,0 +1,254 @@
+# Copyright (c) 2007-2012 by Enrique Pérez Arnaud <enriquepablo@gmail.com>
+#
+# This file is part of the terms project.
+# https://github.com/enriquepablo/terms
+#
+# The terms project is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The terms project is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any part of the terms project.
+# If not, see <http://www.gnu.org/licenses/>.
+
+from sqlalchemy import MetaData, Table, Column, Index, event
+from sqlalchemy import ForeignKey, Integer, Boolean
+from sqlalchemy.orm import aliased
+
+from terms.core.terms import Term, Predicate, isa, are
+from terms.core.factset import Fact, NumberSegment, ColumnVar
+from terms.core.factset import CHUNK, TIME_LABELS
+
+
+class WideTable(object):
+    '''
+    A table for the facts of a verb,
+    with a column for the truth value
+    and a column for each label.
+    '''
+
+    def __init__(self, verb, metadata, lexicon):
+        self.verb = verb
+        self.labels = {}
+        for ot in verb.object_types:
+            num = are(ot.obj_type, lexicon.number)
+            self.labels[ot.label] = num and 'num' or 'term'
+        for label in TIME_LABELS:
+            self.labels.setdefault(label, 'num')
+        cols = [Column('fact_id', Integer, ForeignKey(Fact.__table__.c.id),
+                       primary_key=True),
+                Column('true_', Boolean)]
+        for label in sorted(self.labels):
+            cols.append(Column(label, Integer))
+        name = 'wide_%d' % verb.id
+        self.table = Table(name, metadata, *cols)
+        for label in sorted(self.labels):
+            Index('ix_%s_%s' % (name, label), self.table.c[label])
+
+    def make_row(self, fact_id, pred, term_id=None):
+        if term_id is None:
+            term_id = lambda term: term.id
+        row = {'fact_id': fact_id, 'true_': pred.true}
+        for label in self.labels:
+            row[label] = None
+        for label in pred.objects:
+            row[label] = self.get_value(label, pred.get_object(label), term_id)
+        return row
+
+    def get_value(self, label, value, term_id):
+        if self.labels[label] == 'num':
+            return int(value.name)
+        return term_id(value)
+
+
+class WideFacts(object):
+    '''
+    Facts of verbs with a fixed signature (verbs none of whose labels
+    can take a predicate) are also stored in a table per verb,
+    with a column per label.
+    Questions about such a verb are answered from its table,
+    with a single indexed scan instead of a join per segment.
+    The segments are still stored, for questions with verb vars,
+    and for the primary network.
+    Tables are created when their verbs are defined,
+    or by termsmigrate for verbs defined before; the facts of a verb
+    without a table are only kept, and asked for, in the segments.
+    '''
+
+    def __init__(self, lexicon):
+        self.lexicon = lexicon
+        self.session = lexicon.session
+        self.metadata = MetaData()
+        self.tables = {}  # verb id to WideTable, or None if there is none
+        event.listen(self.session, 'after_rollback', self.clear)
+
+    def clear(self, *args):
+        # the tables, or their verbs, may have been created
+        # in the rolled back transaction
+        self.tables.clear()
+        self.metadata.clear()
+
+    def qualifies(self, verb):
+        for ot in verb.object_types:
+            otype = ot.obj_type
+            if otype is self.lexicon.word or isa(otype, self.lexicon.verb):
+                return False
+        return True
+
+    def get_table(self, verb):
+        '''
+        Get the WideTable for verb,
+        or None if it does not qualify, or its table is not in the db.
+        '''
+        if verb.var or verb.id is None:
+            return None
+        try:
+            return self.tables[verb.id]
+        except KeyError:
+            pass
+        wtable = None
+        if self.qualifies(verb):
+            wtable = WideTable(verb, self.metadata, self.lexicon)
+            conn = self.session.connection()
+            if not conn.dialect.has_table(conn, wtable.table.name):
+                self.metadata.remove(wtable.table)
+                wtable = None
+        self.tables[verb.id] = wtable
+        return wtable
+
+    def create_table(self, verb):
+        '''
+        Create the table for a verb, if it qualifies and it is not
+        in the db, and fill it from the facts of the verb already there.
+        Return whether it was created.
+        '''
+        if self.get_table(verb) is not None or not self.qualifies(verb):
+            return False
+        wtable = WideTable(verb, self.metadata, self.lexicon)
+        wtable.table.create(self.session.connection())
+        self._fill(wtable)
+        self.tables[verb.id] = wtable
+        return True
+
+    def create_tables(self):
+        '''
+        Create the tables of all the verbs that qualify and have none.
+        Return the number of tables created.
+        '''
+        verbs = self.lexicon.get_subterms(self.lexicon.exist)
+        return sum(1 for verb in verbs if self.create_table(verb))
+
+    def _fill(self, wtable):
+        ptable = Predicate.__table__
+        q = self.session.query(Fact).join(ptable, ptable.c.id==Fact.pred_id)
+        q = q.filter(ptable.c.type_id==wtable.verb.id)
+        rows = []
+        for fact in q.yield_per(CHUNK):
+            rows.append(wtable.make_row(fact.id, fact.pred))
+        if rows:
+            self.session.execute(wtable.table.insert(), rows)
+
+    def add_fact(self, fact, pred):
+        wtable = self.get_table(pred.term_type)
+        if wtable is not None:
+            row = wtable.make_row(fact.id, pred)
+            self.session.execute(wtable.table.insert(), [row])
+
+    def add_facts(self, fids, preds, term_id):
+        '''
+        Insert the rows for many new facts,
+        with one executemany per table.
+        '''
+        rows = {}
+        for fid, pred in zip(fids, preds):
+            wtable = self.get_table(pred.term_type)
+            if wtable is not None:
+                row = wtable.make_row(fid, pred, term_id)
+                rows.setdefault(wtable.table, []).append(row)
+        for table, trows in rows.items():
+            self.session.execute(table.insert(), trows)
+
+    def add_object(self, fact, label, value):
+        wtable = self.get_table(fact.pred.term_type)
+        if wtable is not None:
+            table = wtable.table
+            value = wtable.get_value(label, value, lambda term: term.id)
+            q = table.update().where(table.c.fact_id==fact.id)
+            self.session.execute(q.values({label: value}))
+
+    def set_value(self, verb, fact_ids, label, value):
+        '''
+        Set the value of label (a number) for the given facts of verb.
+        '''
+        wtable = self.get_table(verb)
+        if wtable is not None:
+            table = wtable.table
+            for n in range(0, len(fact_ids), CHUNK):
+                q = table.update().where(table.c.fact_id.in_(fact_ids[n:n + CHUNK]))
+                self.session.execute(q.values({label: value}))
+
+    def remove_fact(self, fact):
+        wtable = self.get_table(fact.pred.term_type)
+        if wtable is not None:
+            table = wtable.table
+            self.session.execute(table.delete().where(table.c.fact_id==fact.id))
+
+    def remove_facts(self, verb, fact_ids):
+        '''
+        Delete the rows of the given facts of verb.
+        '''
+        wtable = self.get_table(verb)
+        if wtable is not None:
+            table = wtable.table
+            for n in range(0, len(fact_ids), CHUNK):
+                q = table.delete().where(table.c.fact_id.in_(fact_ids[n:n + CHUNK]))
+                self.session.execute(q)
+
+    def query_facts(self, factset, wtable, pred, taken_vars, qfacts, fact):
+        '''
+        Add pred to qfacts, as query_facts does with segments,
+        but with a single join of the wide table.
+        '''
+        table = wtable.table.alias()
+        qfacts = qfacts.join(table, table.c.fact_id==fact.id)
+        qfacts = qfacts.filter(table.c.true_==pred.true)
+        conditions = []
+        for label in sorted(pred.objects):
+            value = pred.get_object(label)
+            col = table.c[label]
+            num = wtable.labels[label] == 'num'
+            if not value.var:
+                if num:
+                    qfacts = qfacts.filter(col==int(value.name))
+                else:
+                    qfacts = qfacts.filter(col==value.id)
+            elif value.name in taken_vars:
+                first = taken_vars[value.name][1]
+                if num:
+                    qfacts = qfacts.filter(col==first.int_value)
+                else:
+                    qfacts = qfacts.filter(col==first.term_id)
+            else:
+                path = (label, num and '_num' or '_term')
+                taken_vars[value.name] = (path, ColumnVar(col))
+                if num:
+                    qfacts = qfacts.filter(col!=None)
+                    if getattr(value, 'set_condition', False):
+                        conditions.append(value.set_condition)
+                elif value.bases:
+                    qfacts = factset.lexicon.join_subterms(qfacts, col, value.bases[0])
+                else:
+                    talias = aliased(Term)
+                    qfacts = qfacts.join(talias, col==talias.id)
+                    qfacts = factset.lexicon.join_subterms(qfacts, talias.type_id,
+                                                           value.term_type)
+        for condition in conditions:
+            condition = NumberSegment.compile_condition(condition, taken_vars)
+            qfacts = qfacts.filter(condition)
+        return qfacts